@@ -0,0 +1,169 @@
+"""
+    Parameter sweeps over simulated sessions.
+
+    Every combination of the values given below is played by a
+    PathFollower bot along bench_path.json, `--repeats` times with
+    different seeds, in a pool of worker processes. Each session runs in
+    its own process because the game's ShowBase is one per process. The
+    outcomes are collected into one CSV row per combination.
+
+    python batch.py [--obstacles 10 50] [--speed 2 3] [--total-time 60 120]
+                    [--separation 2] [--cohesion 4] [--alignment 0 1] [--pursue 0.4]
+                    [--steering pandai crowd] [--repeats 3] [--jitter 1.0]
+                    [--processes 8] [--path bench_path.json] [--out batch_results.csv]
+
+    Parameters that are not given keep the level's values.
+"""
+import argparse, itertools, json, multiprocessing, random, time
+
+# Grid parameters and how each one is applied to a World
+PARAMETERS = ["obstacles", "speed", "total_time", "separation", "cohesion", "alignment",
+              "pursue", "steering"]
+# Position of each flock weight in World.flockParams; Flock() takes them
+# as unsigned ints
+FLOCK_WEIGHTS = {"separation": 3, "cohesion": 4, "alignment": 5}
+
+
+def configureWorld(world, params):
+    if "obstacles" in params:
+        world.obstacle_count = params["obstacles"]
+    if "speed" in params:
+        world.speed = params["speed"]
+    if "total_time" in params:
+        world.level.timeLimit = params["total_time"]
+    if "pursue" in params:
+        world.pursueWeight = params["pursue"]
+    if "steering" in params:
+        world.steeringBackend = params["steering"]
+    flockParams = list(world.flockParams)
+    for name, index in FLOCK_WEIGHTS.items():
+        if name in params:
+            flockParams[index] = params[name]
+    world.flockParams = tuple(flockParams)
+
+
+def runSession(job):
+    """
+        Play one session in this worker process and return its outcome.
+    """
+    params, seed, waypoints, jitter = job
+    from headless import Simulation, PathFollower
+
+    # Each seed takes a slightly different line through the waypoints
+    rng = random.Random(seed)
+    waypoints = [(x + rng.uniform(-jitter, jitter), y + rng.uniform(-jitter, jitter))
+                 for x, y in waypoints[:-1]] + waypoints[-1:]
+
+    def configure(world):
+        world.seed = seed
+        configureWorld(world, params)
+
+    sim = Simulation(configure=configure)
+    sim.driver = PathFollower(sim.world, waypoints)
+    report = sim.run(sim.world.level.timeLimit + 60)
+    result = report["result"] or {"won": False, "elapsed": report["simulated_seconds"],
+                                  "health": sim.world.health, "time_left": sim.world.time_left}
+    return {"params": params, "seed": seed, "won": result["won"], "elapsed": result["elapsed"],
+            "health": result["health"], "wall_seconds": report["wall_seconds"]}
+
+
+def grid(args):
+    names = []
+    values = []
+    for name in PARAMETERS:
+        given = getattr(args, name)
+        if given:
+            names.append(name)
+            values.append(given)
+    return [dict(zip(names, combination)) for combination in itertools.product(*values)]
+
+
+def mean(values):
+    if not values:
+        return ""
+    return "%g" % (sum(values) / float(len(values)))
+
+
+def summarize(combinations, results):
+    """
+        One row per combination: win rate, time to goal over the wins, and
+        health at the end.
+    """
+    rows = []
+    for params in combinations:
+        runs = [r for r in results if r["params"] == params]
+        wins = [r for r in runs if r["won"]]
+        row = dict(params)
+        row.update({"runs": len(runs),
+                    "wins": len(wins),
+                    "win_rate": "%g" % (len(wins) / float(len(runs))),
+                    "mean_time_to_goal": mean([r["elapsed"] for r in wins]),
+                    "min_time_to_goal": "%g" % min([r["elapsed"] for r in wins]) if wins else "",
+                    "mean_health": mean([max(0.0, r["health"]) for r in runs]),
+                    "mean_wall_seconds": mean([r["wall_seconds"] for r in runs])})
+        rows.append(row)
+    return rows
+
+
+def writeTable(path, names, rows):
+    columns = names + ["runs", "wins", "win_rate", "mean_time_to_goal", "min_time_to_goal",
+                       "mean_health", "mean_wall_seconds"]
+    f = open(path, "w")
+    try:
+        f.write(",".join(columns) + "\n")
+        for row in rows:
+            f.write(",".join([str(row.get(column, "")) for column in columns]) + "\n")
+    finally:
+        f.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sweep game parameters over simulated sessions")
+    parser.add_argument("--obstacles", type=int, nargs="+")
+    parser.add_argument("--speed", type=float, nargs="+")
+    parser.add_argument("--total-time", type=float, nargs="+")
+    parser.add_argument("--separation", type=int, nargs="+")
+    parser.add_argument("--cohesion", type=int, nargs="+")
+    parser.add_argument("--alignment", type=int, nargs="+")
+    parser.add_argument("--pursue", type=float, nargs="+")
+    parser.add_argument("--steering", nargs="+", choices=["pandai", "crowd"])
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--jitter", type=float, default=1.0, help="waypoint jitter per seed")
+    parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--path", default="bench_path.json")
+    parser.add_argument("--out", default="batch_results.csv")
+    args = parser.parse_args()
+
+    f = open(args.path)
+    try:
+        waypoints = [tuple(point) for point in json.load(f)]
+    finally:
+        f.close()
+
+    combinations = grid(args)
+    jobs = [(params, seed, waypoints, args.jitter)
+            for params in combinations for seed in range(args.repeats)]
+    print("%d combinations x %d seeds on %d processes" % (len(combinations), args.repeats,
+                                                          args.processes))
+
+    # A fresh worker per session: ShowBase cannot be rebuilt in-process
+    t0 = time.time()
+    pool = multiprocessing.Pool(args.processes, maxtasksperchild=1)
+    try:
+        results = []
+        for result in pool.imap_unordered(runSession, jobs):
+            results.append(result)
+            print("%d/%d %s seed %d: %s in %.1f s" % (
+                len(results), len(jobs), json.dumps(result["params"], sort_keys=True),
+                result["seed"], "won" if result["won"] else "lost", result["elapsed"]))
+    finally:
+        pool.close()
+        pool.join()
+
+    names = [name for name in PARAMETERS if getattr(args, name)]
+    writeTable(args.out, names, summarize(combinations, results))
+    print("%d sessions in %.1f s -> %s" % (len(results), time.time() - t0, args.out))
+
+
+if __name__ == "__main__":
+    main()
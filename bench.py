@@ -0,0 +1,482 @@
+"""
+    Benchmarks for the obstacle course.
+
+    python bench.py flockers [--counts 10 100 1000] [--frames 200] [--rays] [--crowd]
+                             [--steering crowd]
+    python bench.py restart [--restarts 100] [--frames 120] [--counts 10 5 20] [--steering crowd]
+                            [--memory-tolerance-kb 1024]
+    python bench.py startup [--runs 3]
+    python bench.py course [--obstacles N] [--windowed | --offscreen] [--crowd] [--steering crowd]
+                           [--no-lod]
+                           [--path bench_path.json | --replay session.rec]
+                           [--out bench_results.json]
+    python bench.py record-path [--path bench_path.json]
+"""
+import argparse, gc, json, math, subprocess, sys, time
+from headless import setup as headless, Simulation, PathFollower
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def peakMemoryKb():
+    if resource is None:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def memoryKb():
+    """
+        Resident memory now, from /proc where there is one, else the peak.
+    """
+    try:
+        f = open("/proc/self/statm")
+    except (IOError, OSError):
+        return peakMemoryKb()
+    try:
+        pages = int(f.read().split()[1])
+    finally:
+        f.close()
+    return pages * (resource.getpagesize() if resource else 4096) // 1024
+
+
+class GcTimer(object):
+    """
+        Counts the garbage collector's passes and the time spent in them.
+        Needs gc.callbacks (Python 3.3); reports zeros without it.
+    """
+
+    def __init__(self):
+        self.collections = 0
+        self.seconds = 0.0
+        self.started = None
+        self.start()
+
+    def start(self):
+        if hasattr(gc, "callbacks"):
+            gc.callbacks.append(self.callback)
+
+    def callback(self, phase, info):
+        if phase == "start":
+            self.started = time.time()
+        elif self.started is not None:
+            self.collections += 1
+            self.seconds += time.time() - self.started
+            self.started = None
+
+    def stop(self):
+        if self.callback in getattr(gc, "callbacks", []):
+            gc.callbacks.remove(self.callback)
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {}
+    def at(p):
+        return values[min(len(values) - 1, int(p * len(values)))] * 1000
+    return {"p50_ms": at(0.5), "p90_ms": at(0.9), "p99_ms": at(0.99),
+            "max_ms": values[-1] * 1000, "mean_ms": sum(values) * 1000 / len(values)}
+
+
+def commitId():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def loadPath(path):
+    f = open(path)
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+
+def runFlockers(count, frames, rays=False, crowd=False, steering="pandai"):
+    """
+        Time the flocker steering and ground-snapping passes with `count`
+        flockers, using per-flocker ground rays instead of the height field
+        if `rays` is set and shared crowd Actors if `crowd` is set.
+    """
+    main = headless()
+    from direct.task import Task
+
+    world = main.World()
+    world.obstacle_count = count
+    world.useHeightField = not rays
+    world.crowdMode = crowd
+    world.steeringBackend = steering
+    world.startGame()
+    task = Task.Task(world.moveFlockers)
+
+    steer = []
+    traverse = []
+    snap = []
+    for i in range(frames):
+        t0 = time.time()
+        world.AIUpdate(task)
+        t1 = time.time()
+        world.cTrav.traverse(render)
+        t2 = time.time()
+        world.moveFlockers(task)
+        t3 = time.time()
+        steer.append(t1 - t0)
+        traverse.append(t2 - t1)
+        snap.append(t3 - t2)
+
+    return {"flockers": count,
+            "rays": rays,
+            "crowd": crowd,
+            "steering": world.steeringBackend,
+            "frames": frames,
+            "steer_ms": median(steer) * 1000,
+            "traverse_ms": median(traverse) * 1000,
+            "snap_ms": median(snap) * 1000,
+            "snap_us_per_flocker": median(snap) * 1e6 / count}
+
+
+def benchFlockers(args):
+    # One process per flocker count so every run starts from a clean scene
+    print("%10s %12s %14s %12s %20s" % ("flockers", "steer ms", "traverse ms", "snap ms",
+                                        "snap us/flocker"))
+    for count in args.counts:
+        command = [sys.executable, __file__, "flockers-run", "--steering", args.steering,
+                   "--count", str(count), "--frames", str(args.frames)]
+        if args.rays:
+            command.append("--rays")
+        if args.crowd:
+            command.append("--crowd")
+        out = subprocess.check_output(command)
+        result = json.loads(out.decode().strip().splitlines()[-1])
+        print("%10d %12.3f %14.3f %12.3f %20.3f" % (count, result["steer_ms"], result["traverse_ms"],
+                                                   result["snap_ms"], result["snap_us_per_flocker"]))
+
+
+def runStartup(bundled=True, modelCache=True):
+    """
+        Time one launch in this process: importing the game, starting
+        ShowBase, building World up to its intro page, loading every
+        preloaded model and starting the first session. `bundled` uses the
+        prebuilt .bam bundles; `modelCache` allows Panda's own model cache.
+    """
+    t0 = time.time()
+    from panda3d.core import loadPrcFileData
+    if not modelCache:
+        loadPrcFileData("startup", "model-cache-dir")
+    import bundles
+    if not bundled:
+        bundles.MANIFEST = None
+    import main
+    t1 = time.time()
+    headless()
+    t2 = time.time()
+    world = main.World()
+    t3 = time.time()
+    while world.assetsPending > 0:
+        taskMgr.step()
+    t4 = time.time()
+    world.startGame()
+    taskMgr.step()
+    t5 = time.time()
+
+    return {"import_ms": (t1 - t0) * 1000,
+            "showbase_ms": (t2 - t1) * 1000,
+            "intro_ms": (t3 - t2) * 1000,
+            "assets_ms": (t4 - t3) * 1000,
+            "start_ms": (t5 - t4) * 1000,
+            "total_ms": (t5 - t0) * 1000}
+
+
+def benchStartup(args):
+    """
+        Launch the game in fresh processes. "cold" parses every model from
+        source with Panda's model cache off, as on a first install; "cached"
+        relies on Panda's model cache, warmed by a first launch; "bundled"
+        loads the prebuilt bundles, rebuilt first if any are stale.
+    """
+    subprocess.check_call([sys.executable, "bundles.py"])
+    modes = [("cold", ["--no-bundles", "--no-model-cache"]),
+             ("cached", ["--no-bundles"]),
+             ("bundled", [])]
+    phases = ["import_ms", "showbase_ms", "intro_ms", "assets_ms", "start_ms", "total_ms"]
+    print("%8s %9s" % ("mode", "process") + "".join(["%12s" % phase[:-3] for phase in phases]))
+    for mode, options in modes:
+        command = [sys.executable, __file__, "startup-run"] + options
+        if mode == "cached":
+            subprocess.check_output(command)
+        results = []
+        walls = []
+        for i in range(args.runs):
+            t0 = time.time()
+            out = subprocess.check_output(command)
+            walls.append(time.time() - t0)
+            results.append(json.loads(out.decode().strip().splitlines()[-1]))
+        print("%8s %9.0f" % (mode, median(walls) * 1000) +
+              "".join(["%12.1f" % median([r[phase] for r in results]) for phase in phases]))
+
+
+def benchRestart(args):
+    """
+        Play through `restarts` sessions, cycling obstacle_count through
+        `counts`. Each session walks the course for `frames` frames with
+        the profiler logging, then ends and shows the restart page for a
+        few frames, so music fades, proximity handlers and the log all
+        run. Nodes, lights and tasks must not pile up, and resident memory
+        may grow by at most `memory_tolerance_kb`. Exits non-zero if
+        anything grew.
+    """
+    import os
+    from panda3d.core import LightAttrib
+
+    def configure(world):
+        world.steeringBackend = args.steering
+        world.profileLog = os.devnull
+    sim = Simulation(obstacle_count=(args.counts or [None])[0], configure=configure)
+    world = sim.world
+    counts = args.counts or [world.obstacle_count]
+    waypoints = loadPath(args.path)
+
+    def play():
+        sim.driver = PathFollower(world, waypoints)
+        for frame in range(args.frames):
+            sim.tick()
+            if sim.finished():
+                break
+        if not sim.finished():
+            world.endGame(False)
+        sim.driver = None
+        for key in world.keyMap:
+            world.setKey(key, 0)
+        for frame in range(10):
+            sim.tick()
+
+    def sample():
+        # A full collection first, so memory is compared without garbage;
+        # it is not counted with the game's own passes
+        gcTimer.stop()
+        gc.collect()
+        gcTimer.start()
+        lights = render.node().getAttrib(LightAttrib)
+        return {"nodes": render.countNumDescendants() + aspect2d.countNumDescendants(),
+                "lights": lights.getNumOnLights() if lights else 0,
+                "tasks": len(taskMgr.getTasks()),
+                "memory_kb": memoryKb()}
+
+    # Sampled at the same point of every cycle through the counts; the
+    # first cycle warms up caches and pools
+    first = last = None
+    gcTimer = GcTimer()
+    t0 = time.time()
+    play()
+    for i in range(args.restarts):
+        world.obstacle_count = counts[(i + 1) % len(counts)]
+        world.restartGame()
+        play()
+        if (i + 1) % len(counts) == 0:
+            last = sample()
+            if first is None:
+                first = last
+    elapsed = time.time() - t0
+    gcTimer.stop()
+    world.profiler.closeLog()
+    if first is None:
+        first = last = sample()
+
+    print("%d sessions of up to %d frames, %.2f ms each" % (args.restarts, args.frames,
+                                                          elapsed * 1000 / (args.restarts + 1)))
+    print("gc: %d collections, %.1f ms" % (gcTimer.collections, gcTimer.seconds * 1000))
+    for name in ("texts", "buttons", "flockerPool"):
+        pool = getattr(world, name, None)
+        if pool is not None:
+            print("%16s %10d created, %d reused" % (name, pool.created, pool.reused))
+    for key in sorted(first):
+        print("%16s %10d -> %d" % (key, first[key], last[key]))
+    leaked = [key for key in ("nodes", "lights", "tasks") if last[key] != first[key]]
+    if last["memory_kb"] - first["memory_kb"] > args.memory_tolerance_kb:
+        leaked.append("memory_kb")
+    if leaked:
+        print("grew across restarts: %s" % ", ".join(leaked))
+        sys.exit(1)
+
+
+def sceneCounts():
+    """
+        Geoms and GeomNodes under render: an upper bound on draw calls.
+    """
+    counts = [node.node().getNumGeoms() for node in render.findAllMatches("**/+GeomNode")]
+    return {"geom_nodes": len([count for count in counts if count]), "geoms": sum(counts)}
+
+
+def benchCourse(args):
+    """
+        Run mainChar along the recorded path from start_point to the end
+        point, or play back a recorded session, and record frame, collision
+        and AI time for every frame.
+    """
+    recording = None
+    if args.replay:
+        from replay import Recording, Player
+        recording = Recording.load(args.replay)
+
+    def configure(world):
+        world.crowdMode = args.crowd
+        world.steeringBackend = args.steering
+        if args.no_lod:
+            world.lodBands = None
+        if recording is not None:
+            recording.configure(world)
+
+    sim = Simulation(obstacle_count=args.obstacles, configure=configure, windowed=args.windowed,
+                     offscreen=args.offscreen)
+    world = sim.world
+    if recording is not None:
+        follower = Player(world, recording)
+    else:
+        follower = PathFollower(world, loadPath(args.path))
+    sim.driver = follower
+
+    frames = []
+    collision = []
+    ai = []
+    t0 = time.time()
+    while sim.time < args.seconds and not sim.finished() and not follower.done:
+        start = time.time()
+        sim.tick()
+        frames.append(time.time() - start)
+        timers = world.profiler.lastTimers
+        collision.append(timers.get("traverse", 0) + timers.get("controller", 0) +
+                         timers.get("moveFlockers", 0) + timers.get("proximity", 0))
+        ai.append(timers.get("AIUpdate", 0))
+    wall = time.time() - t0
+
+    report = {"commit": commitId(),
+              "config": {"obstacles": world.obstacle_count, "windowed": args.windowed,
+                         "offscreen": args.offscreen, "lod": not args.no_lod,
+                         "crowd": world.crowdMode, "steering": world.steeringBackend,
+                         "path": args.path, "replay": args.replay},
+              "frames": len(frames),
+              "simulated_seconds": sim.time,
+              "wall_seconds": wall,
+              "reached_end": follower.done or bool(world.gameResult and world.gameResult["won"]),
+              "result": world.gameResult,
+              "frame_time": percentiles(frames),
+              "collision_time": percentiles(collision),
+              "ai_time": percentiles(ai),
+              "scene": sceneCounts(),
+              "peak_memory_kb": peakMemoryKb()}
+
+    f = open(args.out, "w")
+    try:
+        json.dump(report, f, indent=2, sort_keys=True)
+    finally:
+        f.close()
+    print("%d frames, frame p50 %.2f ms p99 %.2f ms, collision p50 %.3f ms, AI p50 %.3f ms -> %s" % (
+        len(frames), report["frame_time"]["p50_ms"], report["frame_time"]["p99_ms"],
+        report["collision_time"]["p50_ms"], report["ai_time"]["p50_ms"], args.out))
+
+
+def recordPath(args):
+    """
+        Play normally and save mainChar's track as the benchmark path.
+    """
+    main = headless(windowed=True)
+    world = main.World()
+    points = []
+
+    def sample(task):
+        if world.levelLoaded:
+            pos = world.mainChar.getPos(render)
+            if not points or math.hypot(pos[0] - points[-1][0], pos[1] - points[-1][1]) > 2:
+                points.append([round(pos[0], 2), round(pos[1], 2)])
+            if world.gameResult is not None:
+                f = open(args.path, "w")
+                f.write(json.dumps(points) + "\n")
+                f.close()
+                print("saved %d waypoints to %s" % (len(points), args.path))
+                return task.done
+        return task.cont
+
+    taskMgr.add(sample, "recordPathTask")
+    run()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Obstacle course benchmarks")
+    commands = parser.add_subparsers(dest="command")
+
+    flockers = commands.add_parser("flockers", help="flocker ground-snapping cost vs flocker count")
+    flockers.add_argument("--counts", type=int, nargs="+", default=[10, 100, 1000])
+    flockers.add_argument("--frames", type=int, default=200)
+    flockers.add_argument("--rays", action="store_true", help="ground rays instead of the height field")
+    flockers.add_argument("--crowd", action="store_true", help="instanced crowd Actors")
+    flockers.add_argument("--steering", default="pandai", choices=["pandai", "crowd"])
+
+    flockersRun = commands.add_parser("flockers-run")
+    flockersRun.add_argument("--count", type=int, required=True)
+    flockersRun.add_argument("--frames", type=int, default=200)
+    flockersRun.add_argument("--rays", action="store_true")
+    flockersRun.add_argument("--crowd", action="store_true")
+    flockersRun.add_argument("--steering", default="pandai", choices=["pandai", "crowd"])
+
+    startup = commands.add_parser("startup", help="cold, cached and bundled launch times")
+    startup.add_argument("--runs", type=int, default=3)
+
+    startupRun = commands.add_parser("startup-run")
+    startupRun.add_argument("--no-bundles", action="store_true")
+    startupRun.add_argument("--no-model-cache", action="store_true")
+
+    restart = commands.add_parser("restart", help="check that restarts do not leak")
+    restart.add_argument("--restarts", type=int, default=100)
+    restart.add_argument("--counts", type=int, nargs="+",
+                         help="obstacle_count for successive sessions, cycled")
+    restart.add_argument("--steering", default="pandai", choices=["pandai", "crowd"])
+    restart.add_argument("--frames", type=int, default=120, help="frames played per session")
+    restart.add_argument("--memory-tolerance-kb", type=int, default=1024)
+    restart.add_argument("--path", default="bench_path.json")
+
+    course = commands.add_parser("course", help="frame, collision and AI time along the course")
+    course.add_argument("--obstacles", type=int, help="flocker count, default the level's")
+    course.add_argument("--windowed", action="store_true")
+    course.add_argument("--offscreen", action="store_true",
+                        help="render with the software renderer into an offscreen buffer")
+    course.add_argument("--crowd", action="store_true")
+    course.add_argument("--steering", default="pandai", choices=["pandai", "crowd"])
+    course.add_argument("--no-lod", action="store_true", help="update every flocker every frame")
+    course.add_argument("--seconds", type=float, default=120)
+    course.add_argument("--path", default="bench_path.json")
+    course.add_argument("--replay", help="a session recorded with --record instead of the path")
+    course.add_argument("--out", default="bench_results.json")
+
+    record = commands.add_parser("record-path", help="play and save the path for course")
+    record.add_argument("--path", default="bench_path.json")
+
+    args = parser.parse_args()
+    if args.command == "flockers":
+        benchFlockers(args)
+    elif args.command == "flockers-run":
+        print(json.dumps(runFlockers(args.count, args.frames, args.rays, args.crowd, args.steering)))
+    elif args.command == "startup":
+        benchStartup(args)
+    elif args.command == "startup-run":
+        print(json.dumps(runStartup(not args.no_bundles, not args.no_model_cache)))
+    elif args.command == "restart":
+        benchRestart(args)
+    elif args.command == "course":
+        benchCourse(args)
+    elif args.command == "record-path":
+        recordPath(args)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
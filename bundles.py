@@ -0,0 +1,140 @@
+"""
+    Prebuilt model bundles.
+
+    Parsing an .egg is slow: models/eve/eve.egg alone takes over a second.
+    The build step loads every model under models/, and every model the
+    levels use from Panda's model path, once and writes each as .bam under
+    bundles/, with its textures' pixels inside. A manifest records the CRC
+    of every source file. At run time resolve() hands out the .bam for a
+    model whose source still matches its recorded CRC, and the source
+    otherwise, so a stale or missing bundle only costs the slow load.
+
+    python bundles.py [levels/level1.json ...] : build the bundles
+"""
+from panda3d.core import Filename
+from terrain import fileCrc
+import json, os
+
+BUNDLE_DIR = "bundles"
+# Read by Manifest.load(); None loads every model from its source
+MANIFEST = os.path.join(BUNDLE_DIR, "manifest.json")
+MODEL_DIR = "models"
+SOURCE_EXTENSIONS = (".egg.pz", ".egg")
+
+
+def modelName(path):
+    """
+        The name a model is loaded by: its path without the file extension.
+    """
+    for extension in SOURCE_EXTENSIONS + (".bam",):
+        if path.endswith(extension):
+            return path[:-len(extension)]
+    return path
+
+
+def sourceModels(directory=MODEL_DIR):
+    names = []
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            if name.endswith(SOURCE_EXTENSIONS):
+                names.append(modelName(os.path.join(root, name).replace(os.sep, "/")))
+    return names
+
+
+class Manifest(object):
+
+    def __init__(self, path=None):
+        self.path = path
+        # Model name -> {"source": path, "crc": CRC of the source, "bundle": .bam path}
+        self.entries = {}
+        # Requested path -> path to load, so each source is checked once a run
+        self.resolved = {}
+
+    @classmethod
+    def load(cls, path=None):
+        if path is None:
+            path = MANIFEST
+        manifest = cls(path)
+        if path is not None and os.path.exists(path):
+            f = open(path)
+            try:
+                manifest.entries = json.load(f)
+            finally:
+                f.close()
+        return manifest
+
+    def resolve(self, path):
+        """
+            The bundle for the model at path if it was built from the
+            current source, else path itself.
+        """
+        if path not in self.resolved:
+            self.resolved[path] = path
+            entry = self.entries.get(modelName(path))
+            if (entry is not None and os.path.exists(entry["bundle"]) and
+                    os.path.exists(entry["source"]) and fileCrc(entry["source"]) == entry["crc"]):
+                self.resolved[path] = entry["bundle"]
+        return self.resolved[path]
+
+    def build(self, names):
+        """
+            Write a bundle for every model name whose source changed since
+            its bundle was built. Returns the names that were rebuilt.
+        """
+        built = []
+        for name in names:
+            self.resolved = {}
+            if self.resolve(name) != name:
+                continue
+            model = loader.loadModel(name, noCache=True)
+            source = model.node().getFullpath().toOsSpecific()
+            # Compressed sources are reported without their .pz
+            if not os.path.exists(source) and os.path.exists(source + ".pz"):
+                source += ".pz"
+            if source.startswith(os.getcwd() + os.sep):
+                source = os.path.relpath(source).replace(os.sep, "/")
+            crc = fileCrc(source)
+            bundle = BUNDLE_DIR + "/" + name.lstrip("/") + ".bam"
+            if not os.path.isdir(os.path.dirname(bundle)):
+                os.makedirs(os.path.dirname(bundle))
+            if not model.writeBamFile(Filename.fromOsSpecific(bundle)):
+                raise IOError("could not write %s" % bundle)
+            model.removeNode()
+            self.entries[name] = {"source": source, "crc": crc, "bundle": bundle}
+            built.append(name)
+        self.resolved = {}
+        return built
+
+    def save(self):
+        f = open(self.path, "w")
+        try:
+            json.dump(self.entries, f, indent=2, sort_keys=True)
+            f.write("\n")
+        finally:
+            f.close()
+
+
+if __name__ == "__main__":
+    import sys, time
+    from panda3d.core import loadPrcFileData
+    # Textures are stored in the bundles as raw pixels: decoding the PNGs
+    # costs more than parsing the .egg files
+    loadPrcFileData("bundles", "window-type none\naudio-library-name null\n"
+                    "bam-texture-mode rawdata")
+    from direct.showbase.ShowBase import ShowBase
+    ShowBase()
+    from level import Level
+
+    names = sourceModels()
+    for path in sys.argv[1:] or ["levels/level1.json"]:
+        for name in Level.load(path).models():
+            name = modelName(name)
+            if name not in names:
+                names.append(name)
+    t0 = time.time()
+    manifest = Manifest.load()
+    built = manifest.build(names)
+    manifest.save()
+    print("%d of %d models bundled in %.1f s -> %s" % (len(built), len(names), time.time() - t0,
+                                                        manifest.path))
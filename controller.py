@@ -0,0 +1,190 @@
+"""
+    Moving the player through the world.
+
+    Each frame the character moves from where it stood toward where the
+    keys sent it as a swept volume, and slides along whatever it meets
+    instead of being put back where it started:
+
+    - Obstacles (the flockers and the static panda) are circles on the XY
+      plane. Only the ones the Proximity grid holds near the move are
+      tested, so the cost follows what is nearby, not the size of the swarm.
+      Each is solid a little inside its touch radius, so resting against
+      one still counts as touching it.
+    - The sides of the world's blockers (trees, rocks, hedges) are tested
+      with a CollisionSphere moved fluidly from the old position to the new
+      one: the traverser checks the whole path, so a fast move cannot skip
+      through thin geometry, and the pusher slides the sphere along it.
+    - Ground the player may not stand on, i.e. the holes in the height
+      field where a blocker covers the terrain, is sampled along the whole
+      move rather than at its end. A move into a hole keeps whichever of
+      its X and Y parts stays on the terrain.
+"""
+from panda3d.core import CollisionTraverser, CollisionNode, CollisionSphere
+from panda3d.core import CollisionHandlerFluidPusher, BitMask32
+import math
+
+# Slide iterations per move: one per surface the move can turn along
+SLIDES = 3
+
+
+class CharacterController(object):
+
+    def __init__(self, character, environment, fromMask, ground=None, radius=0.25, height=0.5):
+        """
+            `ground` is the level's HeightField, if it has one. `radius` and
+            `height` (of the sphere's centre above the character's origin)
+            are in world units.
+        """
+        self.character = character
+        self.environment = environment
+        self.ground = ground
+        self.radius = radius
+        # How far inside an obstacle's touch radius it becomes solid
+        self.skin = 0.05
+        # Proximity holding the obstacles, and the kind to collide with
+        self.obstacles = None
+        self.obstacleKind = "obstacle"
+
+        # The sphere lives in the character's scaled space
+        scale = character.getSz()
+        sphere = CollisionSphere(0, 0, height / scale, radius / scale)
+        node = CollisionNode("controller")
+        node.addSolid(sphere)
+        node.setFromCollideMask(fromMask)
+        node.setIntoCollideMask(BitMask32.allOff())
+        self.sphereNp = character.attachNewNode(node)
+
+        self.traverser = CollisionTraverser("controller")
+        self.traverser.setRespectPrevTransform(True)
+        self.pusher = CollisionHandlerFluidPusher()
+        self.pusher.setHorizontal(True)
+        self.pusher.addCollider(self.sphereNp, character)
+        self.traverser.addCollider(self.sphereNp, self.pusher)
+
+    def destroy(self):
+        self.traverser.clearColliders()
+        self.pusher.clearColliders()
+        self.sphereNp.removeNode()
+
+    def move(self, start, target):
+        """
+            Move the character from start toward target, both under render,
+            and leave it where it got to. Z is left at start's; the ground
+            is the caller's business.
+        """
+        x, y = self.slideObstacles(start[0], start[1], target[0], target[1])
+        character = self.character
+        character.setPos(start)
+        character.setFluidPos(x, y, start[2])
+        self.traverser.traverse(self.environment)
+        x, y = self.slideGround(start[0], start[1], character.getX(), character.getY())
+        character.setPos(x, y, start[2])
+
+    def nearbyObstacles(self, x0, y0, x1, y1):
+        """
+            (x, y, solid radius) of every obstacle the move could reach.
+        """
+        if self.obstacles is None:
+            return []
+        cx = (x0 + x1) * 0.5
+        cy = (y0 + y1) * 0.5
+        reach = math.hypot(x1 - x0, y1 - y0) * 0.5 + self.radius
+        circles = []
+        for entry in self.obstacles.near(cx, cy, reach, self.obstacleKind):
+            pos = entry.nodePath.getPos(render)
+            circles.append((pos[0], pos[1], max(0.0, entry.radius - self.skin)))
+        return circles
+
+    def slideObstacles(self, x0, y0, x1, y1):
+        """
+            Sweep the point (x0, y0) to (x1, y1) against the obstacle
+            circles. At the first contact the rest of the move loses its
+            component into the circle and carries on along it. Finally
+            the point is pushed out of any circle that moved onto it.
+        """
+        circles = self.nearbyObstacles(x0, y0, x1, y1)
+        if not circles:
+            return x1, y1
+        x, y = x0, y0
+        dx, dy = x1 - x0, y1 - y0
+        for i in range(SLIDES):
+            t, hit = firstContact(x, y, dx, dy, circles)
+            if hit is None:
+                x += dx
+                y += dy
+                break
+            x += dx * t
+            y += dy * t
+            nx, ny = x - hit[0], y - hit[1]
+            length = math.hypot(nx, ny) or 1.0
+            nx /= length
+            ny /= length
+            rest = 1.0 - t
+            dx *= rest
+            dy *= rest
+            into = dx * nx + dy * ny
+            dx -= into * nx
+            dy -= into * ny
+
+        for cx, cy, r in circles:
+            ox, oy = x - cx, y - cy
+            distance = math.hypot(ox, oy)
+            if distance < r:
+                if distance == 0:
+                    ox, oy, distance = 1.0, 0.0, 1.0
+                x = cx + ox * r / distance
+                y = cy + oy * r / distance
+        return x, y
+
+
+    def walkable(self, x0, y0, x1, y1):
+        """
+            Whether the straight move stays on the terrain, sampled at half
+            the height field's spacing. Off the field counts as a hole.
+        """
+        ground = self.ground
+        dx, dy = x1 - x0, y1 - y0
+        steps = max(1, int(math.ceil(math.hypot(dx, dy) / (ground.step * 0.5))))
+        for i in range(1, steps + 1):
+            t = float(i) / steps
+            z = ground.getHeight(x0 + dx * t, y0 + dy * t)
+            if z is None or z != z:
+                return False
+        return True
+
+    def slideGround(self, x0, y0, x1, y1):
+        if self.ground is None or self.walkable(x0, y0, x1, y1):
+            return x1, y1
+        for x, y in ((x1, y0), (x0, y1)):
+            if self.walkable(x0, y0, x, y):
+                return x, y
+        return x0, y0
+
+
+def firstContact(x, y, dx, dy, circles):
+    """
+        Earliest fraction t of the move (dx, dy) from (x, y) at which the
+        point enters one of the circles, and that circle, or (1, None).
+        Circles the point is already inside, or is moving out of, are
+        skipped.
+    """
+    a = dx * dx + dy * dy
+    if a == 0:
+        return 1.0, None
+    best = 1.0
+    hit = None
+    for circle in circles:
+        cx, cy, r = circle
+        ox, oy = x - cx, y - cy
+        b = ox * dx + oy * dy
+        c = ox * ox + oy * oy - r * r
+        if c < 0 or b >= 0:
+            continue
+        disc = b * b - a * c
+        if disc < 0:
+            continue
+        t = (-b - math.sqrt(disc)) / a
+        if t < best:
+            best = t
+            hit = circle
+    return best, hit
@@ -0,0 +1,214 @@
+"""
+    Vectorized flocking and pursuit for large swarms.
+
+    A drop-in alternative to registering every flocker with the panda3d.ai
+    AIWorld. Separation, alignment, cohesion and pursuit are computed for
+    all agents at once with NumPy. A uniform neighbour grid keeps the cost
+    close to linear in the number of agents: cohesion and alignment use
+    per-cell sums, and separation only looks at pairs in the small cells
+    around each agent.
+
+    The constructor takes the same numbers the game passes to Flock,
+    AICharacter and pursue, so both backends share one configuration.
+
+    update() can limit the steering to the agents a lod.LodScheduler has
+    due. Every agent keeps moving on its last steering force in between,
+    and every node is moved every frame, so far agents move smoothly and
+    only turn less often.
+"""
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+available = numpy is not None
+
+
+class CrowdEngine(object):
+
+    def __init__(self, nodes, target, flockParams, aiParams, pursueWeight, arrivalRadius=1.0):
+        """
+            flockParams is Flock(id, viewAngle, viewRadius, separation,
+            cohesion, alignment); aiParams is AICharacter(mass, movtForce,
+            maxForce). PandAI moves a character up to movtForce per frame,
+            so at 60 fps that is the top speed in units per second / 60.
+            maxForce is used as the acceleration limit. Pursuit stops
+            inside arrivalRadius, as PandAI's does once the whole-unit
+            distance to the target is 0: AIWorld flockers close to about
+            0.85 units of a standing player.
+        """
+        flockId, viewAngle, viewRadius, separation, cohesion, alignment = flockParams
+        mass, movtForce, maxForce = aiParams
+        self.nodes = list(nodes)
+        self.target = target
+        self.viewRadius = float(viewRadius)
+        self.weights = (float(separation), float(cohesion), float(alignment), float(pursueWeight))
+        self.maxSpeed = movtForce * 60.0
+        self.maxAccel = float(maxForce)
+        self.arrivalRadius = arrivalRadius
+        # Separation acts inside a fifth of the view radius
+        self.personalSpace = self.viewRadius / 5.0
+        self.reset()
+
+    def reset(self):
+        """
+            Re-read positions from the nodes and bring every agent to rest.
+        """
+        n = len(self.nodes)
+        self.pos = numpy.zeros((n, 2))
+        for i, node in enumerate(self.nodes):
+            self.pos[i] = (node.getX(), node.getY())
+        self.vel = numpy.zeros((n, 2))
+
+        # Agents spawned on the same spot have no direction to separate in;
+        # fan them out on a small sunflower spiral
+        k = numpy.arange(n)
+        angle = k * math.pi * (3 - math.sqrt(5))
+        self.pos += 0.2 * numpy.sqrt(k)[:, None] * numpy.stack([numpy.cos(angle), numpy.sin(angle)], axis=1)
+        self.force = numpy.zeros((n, 2))
+
+    def cellKeys(self, cellSize):
+        """
+            An integer key per agent for its grid cell, and the key stride
+            between neighbouring cells along X.
+        """
+        cells = numpy.floor(self.pos / cellSize).astype(numpy.int64)
+        cells -= cells.min(axis=0) - 1
+        width = cells[:, 1].max() + 2
+        return cells[:, 0] * width + cells[:, 1], width
+
+    def neighbourPairs(self, cellSize, agents):
+        """
+            Pairs (i, j) of agents in the same or adjacent grid cells,
+            where i is a position in `agents` and j an agent index, built
+            without a Python loop over agents.
+        """
+        keys, width = self.cellKeys(cellSize)
+        order = numpy.argsort(keys, kind="mergesort")
+        sortedKeys = keys[order]
+
+        firsts = []
+        seconds = []
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                other = keys[agents] + dx * width + dy
+                start = numpy.searchsorted(sortedKeys, other, "left")
+                end = numpy.searchsorted(sortedKeys, other, "right")
+                counts = end - start
+                total = counts.sum()
+                if total == 0:
+                    continue
+                # For each agent, the run of sorted indices start..end
+                runStart = numpy.repeat(start - numpy.cumsum(counts) + counts, counts)
+                firsts.append(numpy.repeat(numpy.arange(len(agents)), counts))
+                seconds.append(order[runStart + numpy.arange(total)])
+        if not firsts:
+            return numpy.zeros(0, numpy.int64), numpy.zeros(0, numpy.int64)
+        return numpy.concatenate(firsts), numpy.concatenate(seconds)
+
+    def neighbourhoodSums(self, values, agents):
+        """
+            For each of `agents`, the sum of `values` over all other agents
+            in its own and the eight surrounding view-radius cells. Sums are
+            built per cell first, so the cost does not depend on how many
+            agents share a neighbourhood.
+        """
+        keys, width = self.cellKeys(self.viewRadius)
+        cellKeys, cellOf = numpy.unique(keys, return_inverse=True)
+        perCell = numpy.zeros((len(cellKeys), values.shape[1]))
+        numpy.add.at(perCell, cellOf, values)
+
+        sums = -values[agents]
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                other = keys[agents] + dx * width + dy
+                index = numpy.minimum(numpy.searchsorted(cellKeys, other), len(cellKeys) - 1)
+                found = cellKeys[index] == other
+                sums += perCell[index] * found[:, None]
+        return sums
+
+    def steering(self, agents):
+        """
+            Steering forces for the agents with the given indices.
+        """
+        n = len(agents)
+        allPos = self.pos
+        pos = allPos[agents]
+        vel = self.vel[agents]
+        separation, cohesion, alignment, pursue = self.weights
+
+        # Cohesion and alignment from the neighbourhood's centre and
+        # average velocity
+        sums = self.neighbourhoodSums(numpy.hstack([numpy.ones((len(allPos), 1)), allPos, self.vel]),
+                                      agents)
+        count = sums[:, 0]
+        has = (count > 0)[:, None]
+        count = numpy.maximum(count, 1)[:, None]
+        centre = sums[:, 1:3] / count
+        heading = sums[:, 3:5] / count
+        force = cohesion * (centre - pos) / self.viewRadius * has
+        force += alignment * (heading - vel) / self.maxSpeed * has
+
+        # Separation from close neighbours, growing sharply as they close in
+        i, j = self.neighbourPairs(self.personalSpace, agents)
+        offset = allPos[j] - pos[i]
+        dist = numpy.sqrt((offset * offset).sum(axis=1))
+        keep = (agents[i] != j) & (dist < self.personalSpace) & (dist > 1e-9)
+        i, offset, dist = i[keep], offset[keep], dist[keep]
+        push = -offset / dist[:, None] * (self.personalSpace / dist - 1)[:, None]
+        force += separation * numpy.stack([numpy.bincount(i, push[:, 0], n),
+                                           numpy.bincount(i, push[:, 1], n)], axis=1)
+
+        # Pursuit: head for the target at full speed until arrival
+        toTarget = numpy.array([self.target.getX(), self.target.getY()]) - pos
+        distance = numpy.sqrt((toTarget * toTarget).sum(axis=1))
+        desired = unit(toTarget) * self.maxSpeed
+        desired *= (distance >= self.arrivalRadius)[:, None]
+        force += pursue * (desired - vel) / self.maxSpeed
+        return force * self.maxAccel
+
+    def update(self, dt, due=None):
+        """
+            Steer the `due` agents (all of them by default), then move every
+            agent and its node.
+        """
+        if not len(self.pos) or dt <= 0:
+            return
+        if due is None:
+            due = numpy.arange(len(self.pos))
+        else:
+            due = numpy.asarray(due, dtype=numpy.int64)
+        if len(due):
+            force = self.steering(due)
+            magnitude = numpy.sqrt((force * force).sum(axis=1))
+            force *= numpy.minimum(1.0, self.maxAccel / numpy.maximum(magnitude, 1e-9))[:, None]
+            self.force[due] = force
+
+        self.vel += self.force * dt
+        speed = numpy.sqrt((self.vel * self.vel).sum(axis=1))
+        self.vel *= numpy.minimum(1.0, self.maxSpeed / numpy.maximum(speed, 1e-9))[:, None]
+        self.pos += self.vel * dt
+
+        # Turn the -Y axis, the way the panda model faces, into the motion
+        heading = numpy.degrees(numpy.arctan2(self.vel[:, 0], -self.vel[:, 1])).tolist()
+        moving = (speed > 1e-3).tolist()
+        for node, (x, y), h, isMoving in zip(self.nodes, self.pos.tolist(), heading, moving):
+            if isMoving:
+                node.setPosHpr(x, y, node.getZ(), h, 0, 0)
+            else:
+                node.setX(x)
+                node.setY(y)
+
+    def distance(self, agent):
+        """
+            XY distance from an agent to the target.
+        """
+        x, y = self.pos[agent]
+        return math.hypot(self.target.getX() - x, self.target.getY() - y)
+
+
+def unit(vectors):
+    length = numpy.sqrt((vectors * vectors).sum(axis=1))
+    return vectors / numpy.maximum(length, 1e-9)[:, None]
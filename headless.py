@@ -0,0 +1,184 @@
+"""
+    Headless simulation of the obstacle course.
+
+    Builds the same level as the game with no window and no audio device,
+    and advances it at a fixed timestep as fast as the CPU allows. Keys come
+    from a script instead of the keyboard.
+
+    python headless.py [--seconds 120] [--dt 0.0166667] [--obstacles N] [--script inputs.json]
+                       [--profile-log frames.csv] [--pstats] [--record session.rec]
+
+    A script is a JSON list of [time, key, value] events, e.g.
+    [[0, "forward", 1], [3.5, "left", 1], [4.0, "left", 0]]
+"""
+import argparse, json, math, time
+
+DEFAULT_DT = 1.0 / 60
+
+
+def setup(windowed=False, offscreen=False):
+    """
+        Import the game and start ShowBase without opening a window or an
+        audio device, or normally if `windowed` is set. `offscreen` renders every frame into
+        an offscreen buffer with the software renderer, so draw and cull
+        cost can be measured without a display.
+    """
+    from panda3d.core import loadPrcFileData
+    if offscreen:
+        loadPrcFileData("headless", "window-type offscreen\nload-display p3tinydisplay\n"
+                        "audio-library-name null")
+    elif not windowed:
+        loadPrcFileData("headless", "window-type none\naudio-library-name null")
+    import main
+    from direct.showbase.ShowBase import ShowBase
+    ShowBase()
+    # No window means no default camera; the game only needs its transform
+    if base.camera is None:
+        base.camera = render.attachNewNode("camera")
+    return main
+
+
+class Simulation(object):
+
+    def __init__(self, dt=DEFAULT_DT, obstacle_count=None, script=None, configure=None,
+                 windowed=False, offscreen=False):
+        """
+            `configure` is called with the World before the level is built,
+            for settings such as speed or crowdMode. obstacle_count defaults
+            to the level's. A windowed simulation renders and runs on the
+            real clock, so dt is only nominal.
+        """
+        main = setup(windowed, offscreen)
+        from panda3d.core import ClockObject
+
+        # Every frame advances the clock by exactly dt, whatever the wall time
+        self.dt = dt
+        if not windowed:
+            globalClock.setMode(ClockObject.MNonRealTime)
+            globalClock.setDt(dt)
+
+        self.world = main.World()
+        if obstacle_count is not None:
+            self.world.obstacle_count = obstacle_count
+        if configure is not None:
+            configure(self.world)
+        self.world.startGame()
+
+        self.script = sorted(script or [])
+        # Optional object whose update() sets keys each frame
+        self.driver = None
+        self.nextEvent = 0
+        self.time = 0.0
+        self.frames = 0
+
+    def press(self, key, value):
+        self.world.setKey(key, value)
+
+    def tick(self):
+        """
+            Apply the scripted input due by now and run one frame of every
+            game task.
+        """
+        while self.nextEvent < len(self.script) and self.script[self.nextEvent][0] <= self.time:
+            at, key, value = self.script[self.nextEvent]
+            self.press(key, value)
+            self.nextEvent += 1
+        if self.driver is not None:
+            self.driver.update()
+        taskMgr.step()
+        self.time += globalClock.getDt()
+        self.frames += 1
+
+    def finished(self):
+        return self.world.gameResult is not None
+
+    def run(self, seconds, until=None):
+        """
+            Tick until the game ends, `seconds` of game time have passed or
+            `until` returns true.
+        """
+        t0 = time.time()
+        while self.time < seconds and not self.finished():
+            if until is not None and until():
+                break
+            self.tick()
+        wall = time.time() - t0
+
+        return {"result": self.world.gameResult,
+                "frames": self.frames,
+                "simulated_seconds": self.time,
+                "wall_seconds": wall,
+                "sim_seconds_per_wall_second": self.time / wall if wall > 0 else 0.0}
+
+
+class PathFollower(object):
+    """
+        Steers mainChar through a list of (x, y) waypoints using the same
+        keys a player would press.
+    """
+
+    def __init__(self, world, waypoints, tolerance=1.5):
+        self.world = world
+        self.waypoints = waypoints
+        self.tolerance = tolerance
+        self.next = 0
+        self.done = False
+
+    def update(self):
+        char = self.world.mainChar
+        pos = char.getPos(render)
+        while self.next < len(self.waypoints):
+            x, y = self.waypoints[self.next]
+            if math.hypot(x - pos[0], y - pos[1]) > self.tolerance:
+                break
+            self.next += 1
+        if self.next == len(self.waypoints):
+            self.done = True
+            for key in ("left", "right", "forward"):
+                self.world.setKey(key, 0)
+            return
+
+        # mainChar runs along its -Y axis
+        facing = render.getRelativeVector(char, (0, -1, 0))
+        x, y = self.waypoints[self.next]
+        dx, dy = x - pos[0], y - pos[1]
+        turn = math.degrees(math.atan2(facing[0] * dy - facing[1] * dx,
+                                       facing[0] * dx + facing[1] * dy))
+        self.world.setKey("left", int(turn > 5))
+        self.world.setKey("right", int(turn < -5))
+        self.world.setKey("forward", int(abs(turn) < 45))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the obstacle course without a window")
+    parser.add_argument("--seconds", type=float, default=120)
+    parser.add_argument("--dt", type=float, default=DEFAULT_DT)
+    parser.add_argument("--obstacles", type=int, help="flocker count, default the level's")
+    parser.add_argument("--script", help="JSON list of [time, key, value] inputs")
+    parser.add_argument("--profile-log", help="per-frame timers as .csv or JSON lines")
+    parser.add_argument("--pstats", action="store_true", help="send the timers to a PStats server")
+    parser.add_argument("--record", help="record the session for replay.py")
+    args = parser.parse_args()
+
+    script = None
+    if args.script:
+        f = open(args.script)
+        try:
+            script = json.load(f)
+        finally:
+            f.close()
+
+    def configure(world):
+        world.profileLog = args.profile_log
+        world.usePStats = args.pstats
+        world.recordPath = args.record
+
+    sim = Simulation(args.dt, args.obstacles, script, configure)
+    report = sim.run(args.seconds)
+    sim.world.profiler.closeLog()
+    sim.world.stopRecording()
+    print(json.dumps(report, indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,327 @@
+"""
+    Level files and their compiled cache.
+
+    A level is a JSON file under levels/ naming the world model, the time
+    limit, the starting health and speed, the flock settings and a list of
+    entities: the player's spawn, the start and end markers, the static
+    obstacle, where flockers spawn and the pickups. An entity is placed
+    with "pos", or with "at" (a node in the world model, e.g. start_point)
+    plus an optional "offset".
+
+    The first load compiles the level next to the JSON file: the world's
+    geometry is regrouped into square chunks of "chunk_size" units, each
+    chunk is flattened so its geometry combines by render state, and the
+    result is written as .bam. Every number the game needs is packed into
+    a .lvl table. Later loads read the table with a few
+    struct.unpack calls and load the .bam, and recompile only when the
+    JSON file or the world model changes.
+
+    Compiling also sorts the world's collision nodes into layers: the
+    ground ("terrain") into TERRAIN_MASK and everything else (trees, rocks,
+    hedges) into BLOCKER_MASK, so a ray that only needs the ground height
+    tests the terrain alone. Large collision nodes are split into cells of
+    "collision_cell_size" units, so the traverser can reject most of the
+    terrain by bounds before testing any polygon.
+"""
+from panda3d.core import Vec3, GeomNode, NodePath, BitMask32, CollisionNode
+from terrain import fileCrc
+import json, math, os, struct
+
+TERRAIN_MASK = BitMask32.bit(0)
+BLOCKER_MASK = BitMask32.bit(1)
+
+MAGIC = b"LVL3"
+HEADER = struct.Struct("<4sII")
+# timeLimit, health, damagePerSecond, speed, flocker count, Flock(6),
+# AICharacter(3), pursue
+SETTINGS = struct.Struct("<ffffII2f3I3ff")
+COUNT = struct.Struct("<I")
+LENGTH = struct.Struct("<H")
+# kind, model and anim indices into the string table, pos, hpr, scale, radius
+ENTITY = struct.Struct("<HHH3f3fff")
+NO_STRING = 0xffff
+
+
+def flockParams(values):
+    """
+        The six Flock() arguments with their types: the id and the
+        separation, cohesion and alignment weights are unsigned ints, the
+        view angle and radius floats.
+    """
+    flockId, viewAngle, viewRadius, separation, cohesion, alignment = values
+    return (int(flockId), float(viewAngle), float(viewRadius),
+            int(separation), int(cohesion), int(alignment))
+
+
+class Entity(object):
+
+    def __init__(self, kind, model, anim, pos, hpr, scale, radius):
+        self.kind = kind
+        # Model path, or None for a bare spawn point
+        self.model = model
+        # Optional "walk" animation for the model
+        self.anim = anim
+        self.pos = pos
+        self.hpr = hpr
+        self.scale = scale
+        # Proximity radius in world units, 0 if the player cannot touch it
+        self.radius = radius
+
+
+class Level(object):
+
+    def __init__(self, path):
+        self.path = path
+        base = os.path.splitext(path)[0]
+        self.cachePath = base + ".lvl"
+        self.worldModel = base + ".bam"
+        self.worldSource = None
+        self.timeLimit = 120.0
+        self.health = 100.0
+        # Health lost per second for each obstacle within its radius
+        self.damagePerSecond = 60.0
+        self.speed = 2.0
+        self.obstacleCount = 10
+        self.flockParams = (1, 270.0, 10.0, 2, 4, 0)
+        self.flockerAIParams = (100, 0.05, 5)
+        self.pursueWeight = 0.4
+        self.entities = []
+
+    def find(self, kind):
+        for entity in self.entities:
+            if entity.kind == kind:
+                return entity
+        return None
+
+    def findAll(self, kinds):
+        return [entity for entity in self.entities if entity.kind in kinds]
+
+    def models(self):
+        """
+            Every model and animation the level's entities use.
+        """
+        paths = []
+        for entity in self.entities:
+            for path in (entity.model, entity.anim):
+                if path is not None and path not in paths:
+                    paths.append(path)
+        return paths
+
+    @classmethod
+    def load(cls, path):
+        """
+            Read the compiled level, compiling it first if the cache is
+            missing or older than the JSON file or the world model.
+        """
+        level = cls(path)
+        sourceCrc = fileCrc(path)
+        if os.path.exists(level.cachePath) and os.path.exists(level.worldModel):
+            if level.readCache(sourceCrc):
+                return level
+        level.compile(sourceCrc)
+        return level
+
+    def readCache(self, sourceCrc):
+        f = open(self.cachePath, "rb")
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        magic, cachedCrc, worldCrc = HEADER.unpack_from(data, 0)
+        if magic != MAGIC or cachedCrc != sourceCrc:
+            return False
+        offset = HEADER.size
+
+        values = SETTINGS.unpack_from(data, offset)
+        offset += SETTINGS.size
+        self.timeLimit, self.health, self.damagePerSecond, self.speed = values[0:4]
+        self.obstacleCount = values[4]
+        self.flockParams = flockParams(values[5:11])
+        self.flockerAIParams = values[11:14]
+        self.pursueWeight = values[14]
+
+        strings = []
+        count, = COUNT.unpack_from(data, offset)
+        offset += COUNT.size
+        for i in range(count):
+            length, = LENGTH.unpack_from(data, offset)
+            offset += LENGTH.size
+            strings.append(data[offset:offset + length].decode("utf-8"))
+            offset += length
+        self.worldSource = strings[0]
+        if not os.path.exists(self.worldSource) or fileCrc(self.worldSource) != worldCrc:
+            return False
+
+        count, = COUNT.unpack_from(data, offset)
+        offset += COUNT.size
+        for i in range(count):
+            record = ENTITY.unpack_from(data, offset)
+            offset += ENTITY.size
+            kind, model, anim = [None if index == NO_STRING else strings[index]
+                                 for index in record[0:3]]
+            self.entities.append(Entity(kind, model, anim, record[3:6], record[6:9],
+                                        record[9], record[10]))
+        return True
+
+    def compile(self, sourceCrc):
+        """
+            Resolve the JSON description against the world model, then write
+            the flattened world and the packed table.
+        """
+        f = open(self.path)
+        try:
+            description = json.load(f)
+        finally:
+            f.close()
+
+        self.worldSource = description["world"]
+        world = loader.loadModel(self.worldSource, noCache=True)
+        self.timeLimit = float(description.get("time_limit", self.timeLimit))
+        self.health = float(description.get("health", self.health))
+        self.damagePerSecond = float(description.get("damage_per_second", self.damagePerSecond))
+        self.speed = float(description.get("speed", self.speed))
+        flock = description.get("flock", {})
+        self.obstacleCount = int(flock.get("count", self.obstacleCount))
+        self.flockParams = flockParams(flock.get("params", self.flockParams))
+        self.flockerAIParams = tuple(flock.get("ai", self.flockerAIParams))
+        self.pursueWeight = float(flock.get("pursue", self.pursueWeight))
+
+        for item in description["entities"]:
+            if "at" in item:
+                anchor = world.find("**/" + item["at"])
+                if anchor.isEmpty():
+                    raise ValueError("%s: no node %s in %s" % (self.path, item["at"], self.worldSource))
+                pos = anchor.getPos(world) + Vec3(*item.get("offset", (0, 0, 0)))
+            else:
+                pos = item["pos"]
+            hpr = (item.get("h", 0.0), item.get("p", 0.0), item.get("r", 0.0))
+            self.entities.append(Entity(item["kind"], item.get("model"), item.get("anim"),
+                                        tuple(pos), hpr, item.get("scale", 1.0),
+                                        item.get("radius", 0.0)))
+
+        for collider in world.findAllMatches("**/+CollisionNode"):
+            if collider.getName() == "terrain":
+                collider.node().setIntoCollideMask(TERRAIN_MASK)
+            else:
+                collider.node().setIntoCollideMask(BLOCKER_MASK)
+        splitColliders(world, description.get("collision_cell_size", 16))
+
+        # Anchors are resolved, so the world can be flattened freely; its
+        # collision nodes keep their names
+        chunkWorld(world, description.get("chunk_size", 64))
+        if not world.writeBamFile(self.worldModel):
+            self.worldModel = self.worldSource
+        world.removeNode()
+        self.writeCache(sourceCrc, fileCrc(self.worldSource))
+
+    def writeCache(self, sourceCrc, worldCrc):
+        strings = [self.worldSource]
+        def index(value):
+            if value is None:
+                return NO_STRING
+            if value not in strings:
+                strings.append(value)
+            return strings.index(value)
+        records = []
+        for entity in self.entities:
+            records.append(ENTITY.pack(index(entity.kind), index(entity.model), index(entity.anim),
+                                       entity.pos[0], entity.pos[1], entity.pos[2],
+                                       entity.hpr[0], entity.hpr[1], entity.hpr[2],
+                                       entity.scale, entity.radius))
+
+        chunks = [HEADER.pack(MAGIC, sourceCrc, worldCrc),
+                  SETTINGS.pack(*((self.timeLimit, self.health, self.damagePerSecond, self.speed,
+                                   self.obstacleCount) +
+                                  tuple(self.flockParams) + tuple(self.flockerAIParams) +
+                                  (self.pursueWeight,))),
+                  COUNT.pack(len(strings))]
+        for value in strings:
+            encoded = value.encode("utf-8")
+            chunks.append(LENGTH.pack(len(encoded)) + encoded)
+        chunks.append(COUNT.pack(len(records)))
+        chunks.extend(records)
+
+        try:
+            f = open(self.cachePath, "wb")
+            try:
+                f.write(b"".join(chunks))
+            finally:
+                f.close()
+        except (IOError, OSError):
+            # A read-only install can still play the freshly compiled level
+            pass
+
+
+def chunkWorld(world, chunkSize):
+    """
+        Move every Geom under world into one GeomNode per chunkSize square
+        on the XY plane, by the centre of its bounds, and flatten each
+        chunk. A chunk then costs a draw call per render state and is culled
+        as a whole. The emptied GeomNodes stay, so collision nodes below
+        them keep their place. A chunkSize of 0 flattens everything into as
+        few Geoms as possible instead, with no culling.
+    """
+    if chunkSize <= 0:
+        world.flattenStrong()
+        return
+    chunksNp = world.attachNewNode("chunks")
+    chunks = {}
+    for nodePath in world.findAllMatches("**/+GeomNode"):
+        node = nodePath.node()
+        netState = nodePath.getNetState()
+        transform = nodePath.getTransform(world)
+        for i in range(node.getNumGeoms()):
+            geom = node.modifyGeom(i)
+            center = transform.getMat().xformPoint(geom.getBounds().getApproxCenter())
+            key = (int(math.floor(center[0] / chunkSize)), int(math.floor(center[1] / chunkSize)))
+            if key not in chunks:
+                chunks[key] = chunksNp.attachNewNode("chunk_%d_%d" % key)
+            piece = NodePath(GeomNode(node.getName()))
+            piece.node().addGeom(geom, netState.compose(node.getGeomState(i)))
+            piece.setTransform(transform)
+            piece.reparentTo(chunks[key])
+        node.removeAllGeoms()
+    for chunk in chunks.values():
+        chunk.flattenStrong()
+
+
+def splitColliders(world, cellSize):
+    """
+        Split each CollisionNode whose solids span several cellSize squares
+        into one node per square, with the same name and masks, so every
+        node gets tight bounds.
+    """
+    if cellSize <= 0:
+        return
+    for collider in world.findAllMatches("**/+CollisionNode"):
+        node = collider.node()
+        mat = collider.getMat(world)
+        cells = {}
+        for i in range(node.getNumSolids()):
+            center = mat.xformPoint(node.getSolid(i).getBounds().getApproxCenter())
+            key = (int(math.floor(center[0] / cellSize)), int(math.floor(center[1] / cellSize)))
+            cells.setdefault(key, []).append(node.getSolid(i))
+        if len(cells) < 2:
+            continue
+        parent = collider.getParent()
+        for key in sorted(cells):
+            cell = CollisionNode(node.getName())
+            cell.setIntoCollideMask(node.getIntoCollideMask())
+            cell.setFromCollideMask(node.getFromCollideMask())
+            for solid in cells[key]:
+                cell.addSolid(solid)
+            parent.attachNewNode(cell).setTransform(collider.getTransform())
+        collider.removeNode()
+
+
+if __name__ == "__main__":
+    # python level.py levels/level1.json ... : compile levels ahead of time
+    import sys
+    from panda3d.core import loadPrcFileData
+    loadPrcFileData("level", "window-type none\naudio-library-name null")
+    from direct.showbase.ShowBase import ShowBase
+    ShowBase()
+    for path in sys.argv[1:]:
+        level = Level(path)
+        level.compile(fileCrc(path))
+        print("compiled %s: %d entities" % (path, len(level.entities)))
@@ -0,0 +1,63 @@
+"""
+    Distance-based update scheduling for crowds of agents.
+
+    Agents are bucketed by their distance to a subject (the player) into
+    bands, each with an update period in frames: near agents update every
+    frame, farther ones every few frames. Agents sharing a period are
+    spread over its frames, so each frame updates about the same number of
+    agents. Only the agents due this frame are looked at, so the cost per
+    frame follows the number of updates, not the size of the crowd.
+"""
+# (distance up to, period in frames); the last band has no limit
+DEFAULT_BANDS = ((20, 1), (50, 4), (None, 8))
+
+
+class LodScheduler(object):
+
+    def __init__(self, count, bands=DEFAULT_BANDS):
+        self.bands = bands
+        self.frame = 0
+        # period -> one set of agents per frame slot
+        self.slots = {}
+        for limit, period in bands:
+            self.slots[period] = [set() for k in range(period)]
+        # Every agent starts in the nearest band, so all update on the
+        # first frame and then spread out by distance
+        nearest = bands[0][1]
+        self.periodOf = [nearest] * count
+        self.slotOf = []
+        for agent in range(count):
+            slot = agent % nearest
+            self.slotOf.append(slot)
+            self.slots[nearest][slot].add(agent)
+
+    def periodFor(self, distance):
+        for limit, period in self.bands:
+            if limit is None or distance < limit:
+                return period
+        return self.bands[-1][1]
+
+    def schedule(self, distanceOf):
+        """
+            The agents due this frame. distanceOf(agent) gives an agent's
+            distance to the subject; it is only asked for due agents, whose
+            bands are then brought up to date.
+        """
+        frame = self.frame
+        self.frame += 1
+        due = []
+        for period, slots in self.slots.items():
+            due.extend(slots[frame % period])
+
+        for agent in due:
+            period = self.periodFor(distanceOf(agent))
+            if period != self.periodOf[agent]:
+                self.slots[self.periodOf[agent]][self.slotOf[agent]].discard(agent)
+                # Stagger by agent index so a band's agents spread over
+                # its frames; the first update in the new band comes
+                # within `period` frames
+                slot = (frame + 1 + agent) % period
+                self.slots[period][slot].add(agent)
+                self.periodOf[agent] = period
+                self.slotOf[agent] = slot
+        return due
@@ -1,16 +1,57 @@
-from direct.directbase.DirectStart import *
+from direct.showbase.ShowBase import ShowBase
 from direct.showbase.DirectObject import DirectObject
-from direct.gui.DirectGui import *
+from direct.gui.DirectButton import DirectButton
 from panda3d.core import CollisionTraverser, CollisionNode
 from panda3d.core import CollisionHandlerQueue,CollisionRay, CollisionSphere
 from panda3d.core import Filename,AmbientLight,DirectionalLight
 from panda3d.core import PandaNode,NodePath,Camera,TextNode
-from panda3d.core import Vec3,Vec4,BitMask32
+from panda3d.core import Vec3,Vec4,BitMask32,LODNode
+from panda3d.core import GraphicsWindow
 from direct.gui.OnscreenText import OnscreenText
 from direct.actor.Actor import Actor
-from panda3d.ai import *
 from direct.task import Task
+from terrain import HeightField
+from proximity import Proximity
+from profiler import FrameProfiler
+from level import Level, TERRAIN_MASK, BLOCKER_MASK
+from music import MusicManager
+from replay import Recorder
+from lod import LodScheduler, DEFAULT_BANDS
+from bundles import Manifest
+from controller import CharacterController
+from pool import Pool
 import random, sys, os, math
+from array import array
+
+# Height reported for an entity whose ground ray did not land on terrain.
+NO_GROUND = float("nan")
+
+# Models and animations startGame needs besides the level's own, fetched
+# in the background while the intro page is up
+GAME_MODELS = ["models/eve/eve", "models/eve/eve-run", "models/eve/eve-walk"]
+
+# Entity kinds in the level file the player can pick up
+PICKUP_KINDS = ("speed", "health", "time")
+
+# Background music for each game state, streamed when first played
+GAME_MUSIC = {"intro": "./songs/start.mp3",
+              "playing": "./songs/playing.mp3",
+              "win": "./songs/win.mp3",
+              "gameover": "./songs/gameover.mp3"}
+
+class Flocker(object):
+    """
+        A pooled flocker: its node and its ground ray, and with PandAI
+        steering the name and current AICharacter it steers under.
+    """
+
+    def __init__(self, nodePath, groundColNp, groundHandler):
+        self.nodePath = nodePath
+        self.groundColNp = groundColNp
+        self.groundHandler = groundHandler
+        self.aiName = None
+        self.aiChar = None
+
 
 class World(DirectObject):
     
@@ -19,15 +60,54 @@ class World(DirectObject):
         base.setBackgroundColor(0,0,0,1)
 
         self.gameStarted = 0
+        self.levelLoaded = 0
         self.gamePaused = 0
         self.timeLeft = 100
-        self.speed = 2
-        self.obstacle_count = 10
+        # Layout, time limit and flock settings; compiled to levels/*.lvl
+        # and levels/*.bam on first use
+        self.setLevel("levels/level1.json")
+        # Timer and damage advance in fixed simulation steps, whatever the
+        # frame rate; a frame longer than maxFrameTime only counts as that
+        self.simStep = 1.0 / 60
+        self.maxFrameTime = 0.25
+        # Ground heights from the baked models/world.hgt instead of per-entity rays
+        self.useHeightField = True
+        # Crowd mode: flockers instance a few shared, phase-offset Actors
+        self.crowdMode = False
+        self.crowdGroups = 4
+        self.crowdLodDistance = 30
+        # Distance bands (up to, period in frames) for flocker updates:
+        # crowd steering and walk animation run less often for far
+        # flockers. Every flocker still moves and is snapped to the ground
+        # each frame. None updates every flocker each frame.
+        self.lodBands = DEFAULT_BANDS
+        # Flocking setup shared by both steering backends comes from the
+        # level as Flock, AICharacter and pursue parameters. "crowd" steers
+        # every flocker at once with NumPy and needs numpy installed;
+        # "pandai" uses AIWorld.
+        self.steeringBackend = "pandai"
+        # Per-task timers: [F3] shows them, profileLog streams them to a
+        # .csv or JSON-lines file, usePStats (or [F4] at any time) sends
+        # them to a PStats server
+        self.profiler = FrameProfiler(self.profileCounts)
+        self.profiler.declare("traverse", "controller")
+        self.profileLog = None
+        self.usePStats = False
+        # Session recording: recordPath ("%d" is replaced by the session
+        # number) receives every frame's dt and input; a replay.Player set
+        # as replayer supplies them instead of the keyboard and mouse.
+        # Each session seeds random with seed, or a fresh seed if it is None.
+        self.seed = None
+        self.recordPath = None
+        self.recorder = None
+        self.replayer = None
+        self.sessions = 0
 
         self.keyMap = {"left":0, "right":0, "forward":0, "backward":0, "cam-left":0, "cam-right":0}
-        self.musicDir = {"intro":"", "playing_game":"", "game_over":""}
         self.acceptOnce('f1', self.startGame)
         self.accept("escape", sys.exit)
+        self.accept("f3", self.profiler.toggleOverlay)
+        self.accept("f4", self.profiler.connectPStats)
         self.accept("arrow_left", self.setKey, ["cam-left",1])
         self.accept("arrow_right", self.setKey, ["cam-right",1])
         self.accept("w", self.setKey, ["forward",1])
@@ -41,22 +121,64 @@ class World(DirectObject):
         self.accept("s-up", self.setKey, ["backward", 0])
         self.accept("d-up", self.setKey, ["right",0])
         
-        # Songs
-        self.loadSongs()
+        self.music = MusicManager(GAME_MUSIC)
+        # GUI widgets are hidden and reused rather than rebuilt each session
+        self.texts = Pool(OnscreenText, self.resetText, self.hideWidget)
+        self.buttons = Pool(DirectButton, self.resetButton, self.hideWidget)
+        # Set while the HUD or the restart page is showing
+        self.timeleft_txt = None
+        self.restart_btn = None
+        # Prebuilt .bam bundles stand in for .egg sources that have not
+        # changed since `python bundles.py`
+        self.bundles = Manifest.load()
+        self.preloadPaths = [self.modelPath(path) for path in
+                             GAME_MODELS + [self.level.worldModel] + self.level.models()]
+        self.assetsPending = len(self.preloadPaths)
         self.showIntroPage()
+        self.preloadModels()
 
-    def loadSongs(self):
-        self.start_song = base.loader.loadSfx("./songs/start.mp3")
-        self.play_song = base.loader.loadSfx("./songs/playing.mp3")
-        self.win_song = base.loader.loadSfx("./songs/win.mp3")
-        self.gameover_song = base.loader.loadSfx("./songs/gameover.mp3")
+    def setLevel(self, path):
+        """
+            Use the level at path, with its speed, flocker count and flock
+            settings. A level already loaded is torn down, and the next
+            startGame builds the new one.
+        """
+        if self.levelLoaded:
+            self.unloadLevel()
+        self.levelPath = path
+        self.level = Level.load(path)
+        self.speed = self.level.speed
+        self.obstacle_count = self.level.obstacleCount
+        self.flockParams = self.level.flockParams
+        self.flockerAIParams = self.level.flockerAIParams
+        self.pursueWeight = self.level.pursueWeight
+
+    def modelPath(self, path):
+        return self.bundles.resolve(path)
+
+    def preloadModels(self):
+        """
+            Start loading every model in the background. Loaded models stay
+            in the model pool, so the Actors built in startGame pick them up
+            without touching the disk.
+        """
+        for path in self.preloadPaths:
+            loader.loadModel(path, callback=self.modelLoaded)
 
-    def changeSongMode(self, sound):
-        if sound.status() == sound.PLAYING:
-            sound.stop()
+    def modelLoaded(self, model):
+        self.assetLoaded()
+
+    def assetLoaded(self):
+        self.assetsPending -= 1
+        if not self.gameStarted:
+            self.updateLoadingText()
+
+    def updateLoadingText(self):
+        total = len(self.preloadPaths)
+        if self.assetsPending > 0:
+            self.loading_txt.setText("Loading... %d%%" % (100 * (total - self.assetsPending) // total))
         else:
-            sound.play()
-            sound.setLoop(True)
+            self.loading_txt.setText("Ready")
 
     def showIntroPage(self):
         control_direction_texts = ["Controls", "~~~~~~~~~~~~~~~~~~",
@@ -65,43 +187,65 @@ class World(DirectObject):
                         "[Mouse] : Rotate Camera",
                         "[W,S] : Run Foward & Backward",
                         "[A,D] : Rotate Player",]
-        self.title_txt = OnscreenText(text = "Timed-obstacle Course Game\nAssignment - 2 (P14)\nMichelle 91148", pos = (0.,0.5), scale = 0.07,fg=(1,0.5,0.5,1),align=TextNode.ACenter,mayChange=1)
+        self.title_txt = self.texts.acquire("Timed-obstacle Course Game\nAssignment - 2 (P14)\nMichelle 91148", pos = (0.,0.5), scale = 0.07,fg=(1,0.5,0.5,1))
         
         # self.control_direction = OnscreenText( intro_text, scale = 0.05, fg = (1,1,1,1), shadow=(.1,.1,.1,1))
         self.control_direction = []
         pos = 0
         for direction in control_direction_texts:
-            self.control_direction.append(OnscreenText(direction, scale = 0.05, fg=(1,1,1,1), shadow=(.1,.1,.1,.1), pos=(0,pos)))
+            self.control_direction.append(self.texts.acquire(direction, scale = 0.05, fg=(1,1,1,1), shadow=(.1,.1,.1,.1), pos=(0,pos)))
             pos -= .07
-        self.btn_play = DirectButton(text = ("PLAY","PLAY","PLAY","disabled"), scale=.1,command=self.startGame, pos=(0.,0.,-0.7))
-        if not self.start_song.status() == self.start_song.PLAYING:
-            self.start_song.play()
-            self.start_song.setLoop(True)
+        self.loading_txt = self.texts.acquire("", pos = (0.,-0.55), scale = 0.05, fg=(1,1,0.5,1))
+        self.updateLoadingText()
+        self.btn_play = self.buttons.acquire("PLAY", self.startGame, (0.,0.,-0.7))
+        self.music.play("intro", fade=0)
 
     def hideIntroPage(self):
-        self.title_txt.destroy()
+        self.texts.release(self.title_txt)
         for control in self.control_direction:
-            control.destroy()
-        self.btn_play.destroy()
-        if self.start_song.status() == self.start_song.PLAYING:
-            self.start_song.stop()
+            self.texts.release(control)
+        self.texts.release(self.loading_txt)
+        self.buttons.release(self.btn_play)
         
     def showHUD(self):
-        self.timeleft_txt = OnscreenText(text = "Time Left: %s"%self.time_left,pos = (0.9, 0.9), scale = 0.05, fg=(1,1,1,1), align=TextNode.ACenter,mayChange=1)
-        self.health_txt = OnscreenText(text = "Health : %s"%self.health, pos=(-0.95, 0.9), scale = 0.05, fg=(1,1,1,1), align=TextNode.ACenter, mayChange=1)
-        if not self.play_song.status() == self.play_song.PLAYING:
-            self.play_song.play()
-            self.play_song.setLoop(True)
+        self.shownTimeLeft = self.displayed(self.time_left)
+        self.shownHealth = self.displayed(self.health)
+        self.timeleft_txt = self.texts.acquire("Time Left: %s"%self.shownTimeLeft,pos = (0.9, 0.9), scale = 0.05, fg=(1,1,1,1))
+        self.health_txt = self.texts.acquire("Health : %s"%self.shownHealth, pos=(-0.95, 0.9), scale = 0.05, fg=(1,1,1,1))
+        self.music.play("playing")
 
     def hideHUD(self):
-        self.timeleft_txt.destroy()
-        self.health_txt.destroy()
-        if self.play_song.status() == self.play_song.PLAYING:
-            self.play_song.stop()
+        self.texts.release(self.timeleft_txt)
+        self.texts.release(self.health_txt)
+        self.timeleft_txt = None
+        self.health_txt = None
 
     def showRestartPage(self):
-        self.game_status_txt = OnscreenText(text = "Erh...", pos = (0.,0.5), scale = 0.07,fg=(1,1,1,1),align=TextNode.ACenter,mayChange=1)
-        self.restart_btn = DirectButton(text = ("RESTART","RESTART","RESTART","disabled"), scale=.1, command=self.restartGame, pos=(0,0,-0.7))
+        self.game_status_txt = self.texts.acquire("Erh...", pos = (0.,0.5), scale = 0.07,fg=(1,1,1,1))
+        self.restart_btn = self.buttons.acquire("RESTART", self.restartGame, (0,0,-0.7))
+
+    def hideRestartPage(self):
+        self.texts.release(self.game_status_txt)
+        self.buttons.release(self.restart_btn)
+        self.game_status_txt = None
+        self.restart_btn = None
+
+    def resetText(self, text, message, pos=(0, 0), scale=0.05, fg=(1,1,1,1), shadow=(0,0,0,0)):
+        text.configure(text=message, pos=pos, scale=scale, fg=fg, shadow=shadow,
+                       align=TextNode.ACenter)
+        text.show()
+
+    def resetButton(self, button, label, command, pos):
+        button["text"] = (label, label, label, "disabled")
+        button["command"] = command
+        button.setScale(.1)
+        button.setPos(pos)
+        # Fit the frame to the new label
+        button.resetFrameSize()
+        button.show()
+
+    def hideWidget(self, widget):
+        widget.hide()
 
     def pauseGame(self):
         if self.gamePaused:
@@ -111,18 +255,52 @@ class World(DirectObject):
         return
 
     def startGame(self):
-        self.gameStarted = 1
-        self.hideIntroPage()
-        self.play_song.play()
-        self.play_song.setLoop(True)
-        self.AIworld = AIWorld(render)
-        
+        if not self.gameStarted:
+            self.gameStarted = 1
+            self.hideIntroPage()
+
+        # The level is loaded once and reset for every later session; a
+        # different obstacle_count only parks or spawns pooled flockers
+        if not self.levelLoaded:
+            self.loadLevel()
+        elif len(self.flockers) != self.obstacle_count:
+            self.setFlockerCount(self.obstacle_count)
+        self.resetLevel()
+        self.showHUD()
+        self.startRecording()
+
+        if self.profileLog is not None and self.profiler.log is None:
+            self.profiler.openLog(self.profileLog)
+        if self.usePStats:
+            self.profiler.connectPStats()
+
+        # Task Manager to control the game
+        self.startTasks()
+
+    def startRecording(self):
+        self.stopRecording()
+        self.sessions += 1
+        if self.recordPath is not None:
+            path = self.recordPath
+            if "%d" in path:
+                path = path % self.sessions
+            self.recorder = Recorder(self, path)
+
+    def stopRecording(self):
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
+    def loadLevel(self):
+        # Created with the flock, and only for the PandAI backend
+        self.AIworld = None
+
         # Load Environment and Players
         self.loadEnv()
+        self.loadHeightField()
 
         self.floater = NodePath(PandaNode("floater"))
         self.floater.reparentTo(render)
-        self.isMoving = False
 
         self.loadMainCharacter()
         self.loadStartPoint()
@@ -136,6 +314,9 @@ class World(DirectObject):
         self.cTrav = CollisionTraverser()
         self.addCollisionOnMainChar()
         self.addCollisionOnCam()
+        # mainChar sweeps through the world instead of being put back
+        self.controller = CharacterController(self.mainChar, self.environment, BLOCKER_MASK,
+                                              self.heightField)
         self.loadObstacles()
 
         # Create Actors
@@ -143,93 +324,183 @@ class World(DirectObject):
         # Add Lighting
         self.createLighting()
 
-        # Counters - Time Limit
-        self.total_time = 120 # 2 mins in seconds
-        self.time_left = 120 # 2 mins in seconds
-        # self.total_time = 5 # 2 mins in seconds
-        # self.time_left = 5 # 2 mins in seconds
-        self.health = 100
-        self.showHUD()
+        # Everything a session moves, and where it started; flockers are
+        # put back at the level's spawn point
+        self.startSpeed = self.speed
+        self.spawnTransforms = []
+        for nodePath in [self.mainChar, self.panda, base.camera]:
+            self.spawnTransforms.append((nodePath, nodePath.getTransform()))
+        self.levelLoaded = 1
 
-        # Task Manager to control the game
-        taskMgr.add(self.updateGame, "updateGameTask")
-        taskMgr.add(self.updateHUD, "updateHUDTask")
+    def resetLevel(self):
+        """
+            Put everything back where it spawned and re-arm the pickups.
+        """
+        for nodePath, transform in self.spawnTransforms:
+            nodePath.setTransform(transform)
+        spawn = self.level.find("flock")
+        for flocker in self.flockers:
+            self.placeEntity(flocker, spawn)
+        for pickup in self.pickups:
+            pickup.unstash()
+        # Steering starts afresh every session, so a session plays out the
+        # same from its seed and settings whatever ran before it
+        self.stopSteering()
+        self.startSteering()
+        # AIWorld has no per-character update, so only the crowd engine's
+        # steering is scheduled by distance
+        self.lod = None
+        if self.lodBands and self.crowd is not None:
+            self.lod = LodScheduler(len(self.flockers), self.lodBands)
+        self.mainChar.stop()
+        self.isMoving = False
+        self.speed = self.startSpeed
+        self.sessionSeed = self.seed
+        if self.sessionSeed is None:
+            self.sessionSeed = random.SystemRandom().randrange(1 << 32)
+        random.seed(self.sessionSeed)
+        self.loadProximity()
+
+        # Counters - Time Limit, in simulated seconds
+        self.total_time = self.level.timeLimit
+        self.time_left = self.total_time
+        self.health = self.level.health
+        self.elapsed = 0.0
+        self.stepTime = 0.0
+        self.gameResult = None
+
+    def unloadLevel(self):
+        """
+            Tear the whole level down before setLevel switches to another,
+            ending any session on it.
+        """
+        self.stopTasks()
+        self.stopRecording()
+        if self.timeleft_txt is not None:
+            self.hideHUD()
+        if self.restart_btn is not None:
+            self.hideRestartPage()
+        # The next session's showHUD starts its track from the top
+        self.music.stop(fade=0)
+        self.stopSteering()
+        while self.flockerRecords:
+            self.flockerPool.release(self.flockerRecords.pop())
+        self.flockerPool.clear()
+        self.flockers = []
+        self.cTrav.clearColliders()
+        self.controller.destroy()
+        self.removeNodes()
+        for light in self.lights:
+            render.clearLight(light)
+            light.removeNode()
+        self.floater.removeNode()
+        self.environment.removeNode()
+        self.levelLoaded = 0
+
+    def startTasks(self):
+        self.stopTasks()
+        timed = self.profiler.wrap
+        taskMgr.add(timed("updateGame", self.updateGame), "updateGameTask")
+        taskMgr.add(timed("proximity", self.updateProximity), "updateProximityTask")
+        taskMgr.add(timed("updateTimers", self.updateTimers), "updateTimersTask")
+        taskMgr.add(timed("updateHUD", self.updateHUD), "updateHUDTask")
         # taskMgr.add(self.updateEffects, "updateEffectsTask")
-        taskMgr.add(self.updateSpeedPill, "updateSpeedPillTask")
-        taskMgr.add(self.updateHealthPill, "updateHealthPillTask")
-        taskMgr.add(self.updateShieldPill, "updateShieldPillTask")
         taskMgr.add(self.checkGameStage, "checkGameStageTask")
-        taskMgr.add(self.AIUpdate, "AIUpdate")
+        taskMgr.add(timed("AIUpdate", self.AIUpdate), "AIUpdate")
+        taskMgr.add(timed("moveFlockers", self.moveFlockers), "moveFlockersTask")
+        taskMgr.add(self.profiler.endFrame, "profilerTask", sort=40)
+
+    def stopTasks(self):
+        for name in ["updateGameTask", "updateProximityTask", "updateTimersTask", "updateHUDTask",
+                     "checkGameStageTask", "AIUpdate", "moveFlockersTask", "profilerTask"]:
+            taskMgr.remove(name)
+
+    def profileCounts(self):
+        entries = 0
+        for i in range(self.cTrav.getNumColliders()):
+            entries += self.cTrav.getHandler(self.cTrav.getCollider(i)).getNumEntries()
+        actors = 0
+        for node in [self.mainChar, self.panda] + self.flockers + self.crowdActors:
+            if isinstance(node, Actor):
+                actors += 1
+        return {"collision_entries": entries,
+                "nodes": render.countNumDescendants(),
+                "actors": actors,
+                "flockers": len(self.flockers)}
 
     def restartGame(self):
-        self.game_status_txt.destroy()
-        self.restart_btn.destroy()
-        self.removeNodes()
-
-        # need to stop the winning or losing songs
-        if self.win_song.status() == self.win_song.PLAYING:
-            self.win_song.stop()
-        if self.gameover_song.status() == self.gameover_song.PLAYING:
-            self.gameover_song.stop()
-
+        self.hideRestartPage()
         self.startGame()
 
     def removeNodes(self):
-        self.mainChar.removeNode()
-        self.panda.removeNode()
-        for i in range(self.obstacle_count):
-            self.flockers[i].removeNode()
-        self.start_point.removeNode()
-        self.end_point.removeNode()
+        nodes = [self.mainChar, self.panda, self.start_point, self.end_point]
+        for node in nodes + self.pickups + self.crowdActors:
+            if isinstance(node, Actor):
+                node.cleanup()
+            else:
+                node.removeNode()
+        self.camGroundColNp.removeNode()
 
     def setKey(self, key, value):
         self.keyMap[key] = value
 
     def loadEnv(self):
-        self.environment = loader.loadModel("models/world")
+        self.environment = loader.loadModel(self.level.worldModel)
         self.environment.reparentTo(render)
         self.environment.setPos(0,0,0)
 
+    def loadHeightField(self):
+        self.heightField = None
+        if self.useHeightField:
+            source = self.level.worldSource
+            self.heightField = HeightField.loadOrBake(self.environment, source,
+                                                      source.split(".")[0] + ".hgt",
+                                                      fromMask=TERRAIN_MASK | BLOCKER_MASK)
+
+    def fieldHeight(self, nodePath):
+        """
+            Terrain Z under nodePath from the height field, or None when there
+            is no height field or nodePath is off the grid.
+        """
+        if self.heightField is None:
+            return None
+        pos = nodePath.getPos(render)
+        return self.heightField.getHeight(pos[0], pos[1])
+
+    def placeEntity(self, nodePath, entity):
+        nodePath.setPosHpr(entity.pos, entity.hpr)
+        nodePath.setScale(entity.scale)
+
+    def loadProp(self, entity):
+        """
+            A static, unanimated level entity: a plain model, flattened so
+            its geometry combines by render state, rather than an Actor.
+        """
+        prop = loader.loadModel(self.modelPath(entity.model))
+        prop.flattenStrong()
+        prop.reparentTo(render)
+        self.placeEntity(prop, entity)
+        return prop
+
     def loadMainCharacter(self):
-        mainCharStartPos = self.environment.find("**/start_point").getPos()
-        self.mainChar = Actor("models/eve/eve",
-                            {"run" : "models/eve/eve-run",
-                             "walk": "models/eve/eve-walk"})
+        mainCharStartPos = self.level.find("player").pos
+        self.mainChar = Actor(self.modelPath("models/eve/eve"),
+                            {"run" : self.modelPath("models/eve/eve-run"),
+                             "walk": self.modelPath("models/eve/eve-walk")})
         self.mainChar.reparentTo(render)
         self.mainChar.setScale(.2)
         self.mainChar.setPos(mainCharStartPos)
 
     def loadStartPoint(self):
-        self.start_point = Actor("models/frowney")
-        self.start_point.reparentTo(render)
-        self.start_point.setScale(.5)
-        self.start_point.setPos(self.mainChar.getPos())
-        self.start_point.setX(self.mainChar.getX() - .7)
+        self.start_point = self.loadProp(self.level.find("start"))
 
     def loadEndPoint(self):
-        """
-            chosen end position = point3(30.9069, 4.36755, 2.91223)
-        """
-        self.end_point = Actor("models/smiley")
-        self.end_point.reparentTo(render)
-        self.end_point.setScale(.5)
-        self.end_point.setPos(30.9069, 4.36755, 3.4)
+        self.end_point = self.loadProp(self.level.find("goal"))
 
     def loadEffects(self):
-        self.speed_dog = Actor("models/dog/evilaibodog")
-        self.speed_dog.reparentTo(render)
-        self.speed_dog.setScale(.5)
-        self.speed_dog.setPos(-71.5866, 43.2459, 2.17505)
-
-        self.health_milk = Actor("models/milk/milkbottle")
-        self.health_milk.reparentTo(render)
-        self.health_milk.setScale(3)
-        self.health_milk.setPos(-81.977, -31.9481, 0.155029)
-
-        self.time_plant = Actor("models/plant/shrubbery2")
-        self.time_plant.reparentTo(render)
-        self.time_plant.setScale(.003)
-        self.time_plant.setPos(-75.8541, 3.21947, 6.19539)
+        self.pickups = []
+        for entity in self.level.findAll(PICKUP_KINDS):
+            self.pickups.append(self.loadProp(entity))
 
     def addCollisionOnMainChar(self):
         self.mainCharGroundRay = CollisionRay()
@@ -237,7 +508,8 @@ class World(DirectObject):
         self.mainCharGroundRay.setDirection(0,0,-1)
         self.mainCharGroundCol = CollisionNode('mainChar')
         self.mainCharGroundCol.addSolid(self.mainCharGroundRay)
-        self.mainCharGroundCol.setFromCollideMask(BitMask32.bit(0))
+        # mainChar's ray also sees blockers, so he cannot walk into a tree
+        self.mainCharGroundCol.setFromCollideMask(TERRAIN_MASK | BLOCKER_MASK)
         self.mainCharGroundCol.setIntoCollideMask(BitMask32.allOff())
         self.mainCharGroundColNp = self.mainChar.attachNewNode(self.mainCharGroundCol)
         self.mainCharGroundHandler = CollisionHandlerQueue()
@@ -249,77 +521,218 @@ class World(DirectObject):
         self.camGroundRay.setDirection(0,0,-1)
         self.camGroundCol = CollisionNode('camRay')
         self.camGroundCol.addSolid(self.camGroundRay)
-        self.camGroundCol.setFromCollideMask(BitMask32.bit(0))
+        self.camGroundCol.setFromCollideMask(TERRAIN_MASK)
         self.camGroundCol.setIntoCollideMask(BitMask32.allOff())
         self.camGroundColNp = base.camera.attachNewNode(self.camGroundCol)
         self.camGroundHandler = CollisionHandlerQueue()
         self.cTrav.addCollider(self.camGroundColNp, self.camGroundHandler)
 
     def loadObstacles(self):
-        startPos = self.start_point.getPos()
-        
+        obstacle = self.level.find("obstacle")
+
+        self.loadCrowd()
+
         #Load the panda actor for static obstacle
-        self.panda = Actor("models/panda-model",{"walk":"models/panda-walk4"})
-        self.panda.setScale(0.0009,0.0009,0.0009)
-        self.panda.reparentTo(render)
-        self.panda.setPos(startPos[0],startPos[1]-5,startPos[2])
-        self.panda.setH(self.panda.getH() + 3)
-        # self.panda.setPos(startPos)
-        # self.panda.setPos(startPos[0], startPos[1], startPos[2])
+        if self.crowdMode:
+            self.panda = render.attachNewNode("panda")
+            self.crowdTemplates[0].instanceTo(self.panda)
+        else:
+            self.panda = Actor(self.modelPath(obstacle.model),{"walk":self.modelPath(obstacle.anim)})
+            self.panda.reparentTo(render)
+        self.placeEntity(self.panda, obstacle)
         
         self.pandaGroundRay = CollisionRay()
         self.pandaGroundRay.setOrigin(0,0,1000)
         self.pandaGroundRay.setDirection(0,0,-1)
         self.pandaGroundCol = CollisionNode('pandaRay')
         self.pandaGroundCol.addSolid(self.pandaGroundRay)
-        self.pandaGroundCol.setFromCollideMask(BitMask32.bit(0))
+        self.pandaGroundCol.setFromCollideMask(TERRAIN_MASK)
         self.pandaGroundCol.setIntoCollideMask(BitMask32.allOff())
         self.pandaGroundColNp = self.panda.attachNewNode(self.pandaGroundCol)
         self.pandaGroundHandler = CollisionHandlerQueue()
-        self.cTrav.addCollider(self.pandaGroundColNp, self.pandaGroundHandler)
+        # The height field already covers every obstacle's ground
+        if self.heightField is None:
+            self.cTrav.addCollider(self.pandaGroundColNp, self.pandaGroundHandler)
 
         ##### Flockers
+        # Each backend's module (NumPy or PandAI) is only imported once it
+        # is used
+        self.useCrowd = False
+        if self.steeringBackend == "crowd":
+            import crowd
+            self.useCrowd = crowd.available
+        if not self.useCrowd:
+            from panda3d.ai import AIWorld
+            self.AIworld = AIWorld(render)
+        self.MyFlock = None
+        self.crowd = None
+
+        # Flockers a session does not need are parked in a pool, hidden,
+        # rather than freed, and spawned from it again when needed
+        self.flockerRecords = []
         self.flockers = []
-        self.flockersGroundRay = []
-        self.flockersGroundCol = []
-        self.flockersGroundColNp = []
-        self.flockersGroundHandler = []
-        self.AIchar = []
-        self.AIbehaviors = []
+        self.flockerPool = Pool(self.createFlocker, self.spawnFlocker, self.parkFlocker,
+                                self.destroyFlocker)
+        self.setFlockerCount(self.obstacle_count)
+
+    def setFlockerCount(self, count):
+        """
+            Park or spawn flockers until `count` are in play. Steering is
+            stopped first and left to resetLevel to start for the new set.
+        """
+        self.stopSteering()
+        while len(self.flockerRecords) > count:
+            self.flockerPool.release(self.flockerRecords.pop())
+        while len(self.flockerRecords) < count:
+            self.flockerRecords.append(self.flockerPool.acquire())
+        self.flockers = [record.nodePath for record in self.flockerRecords]
+        self.flockersGroundHandler = [record.groundHandler for record in self.flockerRecords]
+
+        # XY and ground heights for the whole flock, refreshed in one pass
+        # per frame
+        self.flockersXY = array('f', [0.0] * (2 * count))
+        self.flockersGroundZ = array('f', [0.0] * count)
+
+    def createFlocker(self):
+        spawn = self.level.find("flock")
+        i = self.flockerPool.created
+        if self.crowdMode:
+            flocker = render.attachNewNode("flocker%s"%i)
+            self.crowdTemplates[i % self.crowdGroups].instanceTo(flocker)
+        else:
+            flocker = Actor(self.modelPath(spawn.model), {"walk":self.modelPath(spawn.anim)})
+            flocker.reparentTo(render)
+            flocker.loop("walk")
+            if self.lodBands:
+                self.setAnimationLod(flocker, spawn.scale)
+
+        # Ground Ray
+        groundRay = CollisionRay()
+        groundRay.setOrigin(0,0,1000)
+        groundRay.setDirection(0,0,-1)
+        groundCol = CollisionNode('flockerRay%s'%i)
+        groundCol.addSolid(groundRay)
+        groundCol.setFromCollideMask(TERRAIN_MASK)
+        groundCol.setIntoCollideMask(BitMask32.allOff())
+        record = Flocker(flocker, flocker.attachNewNode(groundCol), CollisionHandlerQueue())
+
+        record.aiName = "flockersAI%s"%i
+        return record
+
+    def spawnFlocker(self, record):
+        record.nodePath.unstash()
+        self.placeEntity(record.nodePath, self.level.find("flock"))
+        if self.heightField is None:
+            self.cTrav.addCollider(record.groundColNp, record.groundHandler)
+
+    def parkFlocker(self, record):
+        record.nodePath.stash()
+        if self.heightField is None:
+            self.cTrav.removeCollider(record.groundColNp)
+
+    def destroyFlocker(self, record):
+        if isinstance(record.nodePath, Actor):
+            record.nodePath.cleanup()
+        else:
+            record.nodePath.removeNode()
+
+    def startSteering(self):
+        if self.useCrowd:
+            import crowd
+            self.crowd = crowd.CrowdEngine(self.flockers, self.mainChar, self.flockParams,
+                                           self.flockerAIParams, self.pursueWeight)
+            return
 
         #Flock AI functions
-        self.MyFlock = Flock(1, 270, 10, 2, 4, 0.8)
+        # AICharacters keep their last velocity, which flocking reads, so
+        # each flock gets new ones; the Actors they steer are reused
+        from panda3d.ai import AICharacter, Flock
+        self.flockId = self.flockParams[0]
+        self.MyFlock = Flock(*self.flockParams)
         self.AIworld.addFlock(self.MyFlock)
-        self.AIworld.flockOn(1);
-        for i in range(self.obstacle_count):
-            self.flockers.append(Actor("models/panda-model",
-                                     {"walk":"models/panda-walk4"}))
-            self.flockers[i].reparentTo(render)
-            self.flockers[i].setScale(0.001)
-            self.flockers[i].setPos(startPos[0],startPos[1]-10,startPos[2])
-            self.flockers[i].loop("walk")
-
-            # Ground Ray
-            self.flockersGroundRay.append(CollisionRay())
-            self.flockersGroundRay[i].setOrigin(0,0,1000)
-            self.flockersGroundRay[i].setDirection(0,0,-1)
-            self.flockersGroundCol.append(CollisionNode('flockerRay%s'%i))
-            self.flockersGroundCol[i].addSolid(self.flockersGroundRay[i])
-            self.flockersGroundCol[i].setFromCollideMask(BitMask32.bit(0))
-            self.flockersGroundCol[i].setIntoCollideMask(BitMask32.allOff())
-            self.flockersGroundColNp.append(self.flockers[i].attachNewNode(self.flockersGroundCol[i]))
-            self.flockersGroundHandler.append(CollisionHandlerQueue())
-            self.cTrav.addCollider(self.flockersGroundColNp[i], self.flockersGroundHandler[i])
-
-            self.AIchar.append(AICharacter("flockersAI%s"%i,self.flockers[i], 100, 0.05, 5))
-            self.AIworld.addAiChar(self.AIchar[i])
-            self.AIbehaviors.append(self.AIchar[i].getAiBehaviors())
-            self.MyFlock.addAiChar(self.AIchar[i])
-            self.AIbehaviors[i].flock(1)
-            self.AIbehaviors[i].pursue(self.mainChar, 0.4)
-
-            taskMgr.add(self.moveFlockers, "moveFlockersTask")
- 
+        self.AIworld.flockOn(self.flockId)
+        for record in self.flockerRecords:
+            record.aiChar = AICharacter(record.aiName, record.nodePath, *self.flockerAIParams)
+            self.AIworld.addAiChar(record.aiChar)
+            self.MyFlock.addAiChar(record.aiChar)
+            behaviors = record.aiChar.getAiBehaviors()
+            behaviors.flock(1)
+            behaviors.pursue(self.mainChar, self.pursueWeight)
+
+    def stopSteering(self):
+        """
+            Take the flockers out of the PandAI flock, so it can be rebuilt
+            around a different set. The crowd engine is simply replaced.
+        """
+        if self.MyFlock is None:
+            return
+        # removeFlock first: it turns flocking off on every member, and
+        # removeAiChar leaves the last one removed in the flock's list
+        self.AIworld.removeFlock(self.flockId)
+        for record in self.flockerRecords:
+            self.AIworld.removeAiChar(record.aiName)
+            record.aiChar = None
+        self.MyFlock = None
+
+    def setAnimationLod(self, actor, scale):
+        """
+            Animate every frame inside the nearest band and once per
+            period of the next band at its outer edge, slowing further
+            beyond. Actor distances are in its own scaled space.
+        """
+        (near, period), (far, farPeriod) = self.lodBands[0], self.lodBands[1]
+        actor.setLODAnimation(far / scale, near / scale, farPeriod / 60.0)
+
+    def loadCrowd(self):
+        """
+            In crowd mode the panda model and its walk cycle are loaded once
+            per phase group rather than once per flocker. Each group is an
+            LODNode: the animated Actor up close, and past crowdLodDistance
+            a plain unanimated copy that needs no skinning.
+        """
+        self.crowdActors = []
+        self.crowdTemplates = []
+        if not self.crowdMode:
+            return
+
+        spawn = self.level.find("flock")
+        farModel = loader.loadModel(self.modelPath(spawn.model))
+        # Switch distances are in the flocker's local, scaled space
+        switch = self.crowdLodDistance / spawn.scale
+        for g in range(self.crowdGroups):
+            actor = Actor(self.modelPath(spawn.model), {"walk":self.modelPath(spawn.anim)})
+            walk = actor.getAnimControl("walk")
+            walk.pose(walk.getNumFrames() * g // self.crowdGroups)
+            walk.loop(False)
+
+            lod = LODNode("pandaLOD%s"%g)
+            template = NodePath(lod)
+            actor.reparentTo(template)
+            lod.addSwitch(switch, 0)
+            farModel.instanceTo(template)
+            lod.addSwitch(switch * 1000, switch)
+
+            self.crowdActors.append(actor)
+            self.crowdTemplates.append(template)
+
+    def loadProximity(self):
+        """
+            Register everything the player can touch. Radii are in world
+            units; the old getDistance checks measured them in the scaled
+            space of each target (e.g. 500 * 0.001 for a flocker).
+        """
+        level = self.level
+        handlers = {"speed": self.takeSpeedPill, "health": self.takeHealthPill,
+                    "time": self.takeShieldPill}
+        self.proximity = Proximity(self.mainChar)
+        for flocker in self.flockers:
+            self.proximity.add(flocker, level.find("flock").radius, "obstacle", moving=True)
+        self.proximity.add(self.panda, level.find("obstacle").radius, "obstacle")
+        for pickup, entity in zip(self.pickups, level.findAll(PICKUP_KINDS)):
+            self.proximity.add(pickup, entity.radius, "pickup", onEnter=handlers[entity.kind])
+        self.proximity.add(self.end_point, level.find("goal").radius, "goal", onEnter=self.reachEndPoint)
+        self.controller.obstacles = self.proximity
+
     def createLighting(self):
         ambientLight = AmbientLight("ambientLight")
         ambientLight.setColor(Vec4(.3, .3, .3, 1))
@@ -327,90 +740,128 @@ class World(DirectObject):
         directionalLight.setDirection(Vec3(-5, -5, -5))
         directionalLight.setColor(Vec4(1, 1, 1, 1))
         directionalLight.setSpecularColor(Vec4(1, 1, 1, 1))
-        render.setLight(render.attachNewNode(ambientLight))
-        render.setLight(render.attachNewNode(directionalLight))
+        self.lights = [render.attachNewNode(ambientLight),
+                       render.attachNewNode(directionalLight)]
+        for light in self.lights:
+            render.setLight(light)
 
     def AIUpdate(self, task):
-        self.AIworld.update()
+        if self.crowd is not None:
+            # Flockers steered this frame, or None for all of them
+            due = None
+            if self.lod is not None:
+                due = self.lod.schedule(self.crowd.distance)
+            self.crowd.update(globalClock.getDt(), due)
+        else:
+            self.AIworld.update()
         return Task.cont
 
-    def checkGameStage(self, task):
+    def endGame(self, won):
         """
             GUI with time taken and restart button when player reaches end point or reaches zero health.
         """
-        # player reach end point
-        player_endpoint_distance = self.mainChar.getDistance(self.end_point)
-        if player_endpoint_distance < 4:
-            taskMgr.remove('updateHUDTask')
-            taskMgr.remove('updateGameTask')
-            taskMgr.remove('updateSpeedPill')
-            taskMgr.remove('updateHealthPill')
-            taskMgr.remove('updateShieldPill')
-            self.hideHUD()
-            self.showRestartPage()
-            self.changeSongMode(self.win_song)
-            if self.play_song.status() == self.play_song.PLAYING:
-                self.play_song.stop()
-            self.game_status_txt.setText("You WIN!")
-            return task.done
+        self.gameResult = {"won": won, "elapsed": self.elapsed,
+                           "health": self.health, "time_left": self.time_left}
+        if won:
+            message, song = "You WIN!", "win"
+        else:
+            message, song = "Game Over", "gameover"
+        taskMgr.remove('updateTimersTask')
+        taskMgr.remove('updateHUDTask')
+        taskMgr.remove('updateGameTask')
+        taskMgr.remove('updateProximityTask')
+        taskMgr.remove('checkGameStageTask')
+        self.stopRecording()
+        self.hideHUD()
+        self.showRestartPage()
+        self.music.play(song)
+        self.game_status_txt.setText(message)
 
+    def checkGameStage(self, task):
         if (self.time_left <= 0 or self.health <= 0):
-            taskMgr.remove('updateHUDTask')
-            taskMgr.remove('updateGameTask')
-            taskMgr.remove('updateSpeedPill')
-            taskMgr.remove('updateHealthPill')
-            taskMgr.remove('updateShieldPill')
-            self.hideHUD()
-            self.showRestartPage()
-            self.changeSongMode(self.gameover_song)
-            if self.play_song.status() == self.play_song.PLAYING:
-                self.play_song.stop()
-            self.game_status_txt.setText("Game Over")
+            self.endGame(False)
             return task.done
         return task.cont
 
-    def updateHUD(self, task):
+    def updateProximity(self, task):
+        self.proximity.update()
+        return task.cont
 
-        # update time
-        self.time_left = self.total_time - int(task.time)
-        self.timeleft_txt.setText("Time Left: %s"%self.time_left)
-
-        # update health
-        for i in range(self.obstacle_count):
-            dis = self.mainChar.getDistance(self.flockers[i])
-            if dis < 500:
-                self.health -= 1
-        dis = self.mainChar.getDistance(self.panda)
-        if dis < 500:
-            self.health -= 1
-        self.health_txt.setText("Health : %s"%self.health)
+    def updateTimers(self, task):
+        """
+            Advance the clock and apply damage in whole simStep steps, so
+            both depend only on simulated time and not on the frame rate.
+        """
+        self.stepTime += min(globalClock.getDt(), self.maxFrameTime)
+        touching = self.proximity.count("obstacle")
+        while self.stepTime >= self.simStep:
+            self.stepTime -= self.simStep
+            self.elapsed += self.simStep
+            self.health -= touching * self.level.damagePerSecond * self.simStep
+        self.time_left = self.total_time - self.elapsed
         return task.cont
 
-    def updateSpeedPill(self, task):
+    def displayed(self, value):
+        # Whole units, rounded up so the HUD only reads 0 once it is spent
+        return max(0, int(math.ceil(value - 1e-6)))
 
-        dis = self.mainChar.getDistance(self.speed_dog)
-        if dis < 2:
-            self.speed_dog.removeNode()
-            self.speed = 4
-            return task.done
+    def updateHUD(self, task):
+        # Text is only regenerated when the displayed number changes
+        timeLeft = self.displayed(self.time_left)
+        if timeLeft != self.shownTimeLeft:
+            self.shownTimeLeft = timeLeft
+            self.timeleft_txt.setText("Time Left: %s"%timeLeft)
+        health = self.displayed(self.health)
+        if health != self.shownHealth:
+            self.shownHealth = health
+            self.health_txt.setText("Health : %s"%health)
         return task.cont
 
-    def updateHealthPill(self, task):
+    def reachEndPoint(self, endPoint):
+        self.endGame(True)
 
-        dis = self.mainChar.getDistance(self.health_milk)
-        if dis < 2:
-            self.health = 100
-            self.health_milk.removeNode()
-            return task.done
-        return task.cont
+    def takeSpeedPill(self, pill):
+        self.proximity.remove(pill)
+        pill.stash()
+        self.speed = 4
 
-    def updateShieldPill(self, task):
-        dis = self.mainChar.getDistance(self.time_plant)
-        if dis < 200:
-            self.time_plant.removeNode()
-            self.total_time += 20
-            return task.done
-        return task.cont
+    def takeHealthPill(self, pill):
+        self.proximity.remove(pill)
+        pill.stash()
+        self.health = self.level.health
+
+    def takeShieldPill(self, pill):
+        self.proximity.remove(pill)
+        pill.stash()
+        self.total_time += 20
+
+    def readMouse(self):
+        """
+            Horizontal pointer offset from the window centre, recentring the
+            pointer. There is no pointer when running headless or into an
+            offscreen buffer.
+        """
+        if not isinstance(base.win, GraphicsWindow):
+            return 0
+        md = base.win.getPointer(0)
+        x = md.getX()
+        if base.win.movePointer(0, base.win.getXSize()//2, base.win.getYSize()//2):
+            return x - base.win.getXSize()//2
+        return 0
+
+    def pollInput(self):
+        """
+            This frame's mouse offset, from the replay if one is running.
+            keyMap is already set by the key events or the replay. Both are
+            recorded with the frame's dt.
+        """
+        if self.replayer is not None:
+            mouseDx = self.replayer.mouseDx
+        else:
+            mouseDx = self.readMouse()
+        if self.recorder is not None:
+            self.recorder.write(globalClock.getDt(), self.keyMap, mouseDx)
+        return mouseDx
 
     def updateGame(self, task):
 
@@ -424,11 +875,9 @@ class World(DirectObject):
             base.camera.setX(base.camera, +20 * globalClock.getDt())
 
         # Track mouse movement and set the camera
-        md = base.win.getPointer(0)
-        x = md.getX()
-        y = md.getY()
-        if base.win.movePointer(0, base.win.getXSize()/2, base.win.getYSize()/2):
-            base.camera.setX(base.camera, (x - base.win.getXSize()/2)* globalClock.getDt())
+        mouseDx = self.pollInput()
+        if mouseDx:
+            base.camera.setX(base.camera, mouseDx * globalClock.getDt())
 
         startpos = self.mainChar.getPos()
 
@@ -441,6 +890,12 @@ class World(DirectObject):
         if (self.keyMap["backward"]!=0):
             self.mainChar.setY(self.mainChar, 25 * globalClock.getDt() * self.speed)
 
+        # Sweep from startpos to where the keys put mainChar, sliding along
+        # obstacles and blockers on the way
+        self.profiler.start("controller")
+        self.controller.move(startpos, self.mainChar.getPos())
+        self.profiler.stop("controller")
+
         # If mainChar is moving, loop the run animation.
         # If he is standing still, stop the animation.
 
@@ -468,36 +923,35 @@ class World(DirectObject):
             base.camera.setPos(base.camera.getPos() - camvec*(5-camdist))
             camdist = 5.0
 
-        # Now check for collisions.
+        # Now check for collisions. With a height field the ground rays
+        # are only needed when mainChar or the camera is off the grid.
 
-        self.cTrav.traverse(render)
+        charZ = self.fieldHeight(self.mainChar)
+        camZ = self.fieldHeight(base.camera)
+        if charZ is None or camZ is None:
+            self.profiler.start("traverse")
+            self.cTrav.traverse(self.environment)
+            self.profiler.stop("traverse")
 
         # Adjust mainChar's Z coordinate.  If mainChar's ray hit terrain,
         # update his Z. If it hit anything else, or didn't hit anything, put
-        # him back where he was last frame.
-
-        entries = []
-        for i in range(self.mainCharGroundHandler.getNumEntries()):
-            entry = self.mainCharGroundHandler.getEntry(i)
-            entries.append(entry)
-        entries.sort(lambda x,y: cmp(y.getSurfacePoint(render).getZ(),
-                                     x.getSurfacePoint(render).getZ()))
-        if (len(entries)>0) and (entries[0].getIntoNode().getName() == "terrain"):
-            self.mainChar.setZ(entries[0].getSurfacePoint(render).getZ())
+        # him back where he was last frame. With a height field the
+        # controller has already kept him on the terrain.
+
+        if charZ is None:
+            charZ = self.highestTerrainZ(self.mainCharGroundHandler)
+        if charZ == charZ:
+            self.mainChar.setZ(charZ)
         else:
             self.mainChar.setPos(startpos)
 
         # Keep the camera at one foot above the terrain,
         # or two feet above mainChar, whichever is greater.
         
-        entries = []
-        for i in range(self.camGroundHandler.getNumEntries()):
-            entry = self.camGroundHandler.getEntry(i)
-            entries.append(entry)
-        entries.sort(lambda x,y: cmp(y.getSurfacePoint(render).getZ(),
-                                     x.getSurfacePoint(render).getZ()))
-        if (len(entries)>0) and (entries[0].getIntoNode().getName() == "terrain"):
-            base.camera.setZ(entries[0].getSurfacePoint(render).getZ()+1.0)
+        if camZ is None:
+            camZ = self.highestTerrainZ(self.camGroundHandler)
+        if camZ == camZ:
+            base.camera.setZ(camZ+1.0)
         if (base.camera.getZ() < self.mainChar.getZ() + 2.0):
             base.camera.setZ(self.mainChar.getZ() + 2.0)
             
@@ -511,24 +965,61 @@ class World(DirectObject):
 
         return task.cont
 
+    def highestTerrainZ(self, handler):
+        """
+            Z of the highest surface a ground ray hit, or NO_GROUND when
+            nothing was hit or the highest surface is not terrain.
+        """
+        best = None
+        bestZ = NO_GROUND
+        for i in range(handler.getNumEntries()):
+            entry = handler.getEntry(i)
+            z = entry.getSurfacePoint(render).getZ()
+            if best is None or z > bestZ:
+                best = entry
+                bestZ = z
+        if best is not None and not (best.getIntoNode().getIntoCollideMask() & TERRAIN_MASK).isZero():
+            return bestZ
+        return NO_GROUND
+
     def moveFlockers(self, task):
-        
-        for i in range(self.obstacle_count):
-            startpos = self.flockers[i].getPos()
-
-            entries = []
-            for j in range(self.flockersGroundHandler[i].getNumEntries()):
-                entry = self.flockersGroundHandler[i].getEntry(j)
-                entries.append(entry)
-            entries.sort(lambda x,y: cmp(y.getSurfacePoint(render).getZ(),
-                                         x.getSurfacePoint(render).getZ()))
-            if (len(entries)>0) and (entries[0].getIntoNode().getName() == "terrain"):
-                self.flockers[i].setZ(entries[0].getSurfacePoint(render).getZ())
+        """
+            Snap every flocker to the terrain in a single sweep: read all
+            the ground heights first, then write them back.
+        """
+        flockers = self.flockers
+        heights = self.flockersGroundZ
+        if self.heightField is not None:
+            # The crowd engine already holds every XY in one array; AIWorld
+            # moved its flockers itself, so theirs are read off the nodes
+            if self.crowd is not None:
+                xy = self.crowd.pos.ravel().tolist()
             else:
-                self.flockers[i].setPos(startpos)
-            
+                xy = self.flockersXY
+                for i in range(len(flockers)):
+                    pos = flockers[i].getPos()
+                    xy[2 * i] = pos[0]
+                    xy[2 * i + 1] = pos[1]
+            getHeight = self.heightField.getHeight
+            for i in range(len(flockers)):
+                z = getHeight(xy[2 * i], xy[2 * i + 1])
+                heights[i] = NO_GROUND if z is None else z
+        else:
+            handlers = self.flockersGroundHandler
+            for i in range(len(flockers)):
+                heights[i] = self.highestTerrainZ(handlers[i])
+
+        # A flocker whose ray missed the terrain keeps its current position
+        for i in range(len(flockers)):
+            z = heights[i]
+            if z == z:
+                flockers[i].setZ(z)
+
         return task.cont
 
 
-base.w = World()
-run()
+if __name__ == "__main__":
+    # The window opens once every module above is imported
+    ShowBase()
+    base.w = World()
+    run()
@@ -0,0 +1,91 @@
+"""
+    Background music for each game state.
+
+    Tracks are streamed from disk by the music AudioManager rather than
+    decoded into memory, and each one is only opened the first time its
+    state is entered. Changing state crossfades from the current track to
+    the next one.
+"""
+from panda3d.core import AudioManager, Filename
+
+
+class MusicManager(object):
+
+    def __init__(self, tracks, fadeTime=1.0):
+        """
+            `tracks` maps a state name, e.g. "intro" or "win", to a sound
+            file.
+        """
+        self.tracks = tracks
+        self.fadeTime = fadeTime
+        self.sounds = {}
+        self.current = None
+        # Sound -> [volume, change per second] while it fades in or out.
+        # Volumes are tracked here since a null audio device reports 0.
+        self.fading = {}
+
+    def sound(self, state):
+        if state not in self.sounds:
+            self.sounds[state] = base.musicManager.getSound(Filename(self.tracks[state]), False,
+                                                            AudioManager.SMStream)
+        return self.sounds[state]
+
+    def play(self, state, fade=None):
+        """
+            Switch to the track for `state`, looping it. Entering the state
+            that is already playing does nothing.
+        """
+        if state == self.current:
+            return
+        if fade is None:
+            fade = self.fadeTime
+        self.stop(fade)
+        self.current = state
+        sound = self.sound(state)
+        sound.setLoop(True)
+        if fade > 0:
+            volume = self.fading[sound][0] if sound in self.fading else 0.0
+            sound.setVolume(volume)
+            self.fadeTo(sound, volume, 1.0 / fade)
+        else:
+            self.fading.pop(sound, None)
+            sound.setVolume(1)
+        if sound.status() != sound.PLAYING:
+            sound.play()
+
+    def stop(self, fade=None):
+        if self.current is None:
+            return
+        if fade is None:
+            fade = self.fadeTime
+        sound = self.sounds[self.current]
+        self.current = None
+        if fade > 0:
+            volume = self.fading[sound][0] if sound in self.fading else 1.0
+            self.fadeTo(sound, volume, -1.0 / fade)
+        else:
+            self.fading.pop(sound, None)
+            sound.stop()
+
+    def fadeTo(self, sound, volume, rate):
+        self.fading[sound] = [volume, rate]
+        if not taskMgr.hasTaskNamed("musicFadeTask"):
+            taskMgr.add(self.updateFades, "musicFadeTask")
+
+    def updateFades(self, task):
+        dt = globalClock.getDt()
+        for sound, (volume, rate) in list(self.fading.items()):
+            volume += rate * dt
+            if volume >= 1:
+                sound.setVolume(1)
+                del self.fading[sound]
+            elif volume <= 0:
+                sound.stop()
+                sound.setVolume(1)
+                del self.fading[sound]
+            else:
+                sound.setVolume(volume)
+                self.fading[sound][0] = volume
+        if not self.fading:
+            return task.done
+        return task.cont
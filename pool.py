@@ -0,0 +1,53 @@
+"""
+    Object pools.
+
+    A pool keeps the objects released to it and hands them out again
+    instead of building new ones, so a long run of sessions does not keep
+    allocating and freeing widgets, Actors and collision nodes. The owner
+    supplies how to make an object, how to ready one for use and how to
+    put one away, e.g. show and hide it.
+"""
+
+
+class Pool(object):
+
+    def __init__(self, create, reset=None, release=None, destroy=None):
+        """
+            create() builds a new object. reset(item, *args, **kw) readies
+            a new or reused one for use, release(item) puts one away and
+            destroy(item) frees one for good when the pool is cleared.
+        """
+        self.create = create
+        self.resetItem = reset
+        self.releaseItem = release
+        self.destroyItem = destroy
+        self.free = []
+        # How often acquire() had to build an object, and how often it
+        # could reuse one
+        self.created = 0
+        self.reused = 0
+
+    def acquire(self, *args, **kw):
+        if self.free:
+            item = self.free.pop()
+            self.reused += 1
+        else:
+            item = self.create()
+            self.created += 1
+        if self.resetItem is not None:
+            self.resetItem(item, *args, **kw)
+        return item
+
+    def release(self, item):
+        if self.releaseItem is not None:
+            self.releaseItem(item)
+        self.free.append(item)
+
+    def clear(self):
+        """
+            Destroy every object waiting in the pool.
+        """
+        if self.destroyItem is not None:
+            for item in self.free:
+                self.destroyItem(item)
+        self.free = []
@@ -0,0 +1,147 @@
+"""
+    Per-frame timers and counters for the game tasks.
+
+    Each game task is wrapped with a named timer, and sections inside a task
+    (the collision traversal, the AIWorld update) can be timed with
+    start/stop. At the end of every frame the profiler takes one sample. It
+    can show the sample on an overlay, append it to a CSV or JSON-lines
+    file, and feed the same timers to PStats when a server is running.
+"""
+from panda3d.core import PStatCollector, PStatClient, TextNode
+from direct.gui.OnscreenText import OnscreenText
+import json, time
+
+clock = getattr(time, "perf_counter", time.time)
+
+
+class FrameProfiler(object):
+
+    def __init__(self, counters=None):
+        """
+            `counters` returns a dict of extra per-frame numbers, e.g. node
+            and Actor counts. It is only called when a sample is shown or
+            logged.
+        """
+        self.counters = counters
+        # Every timer name seen or declared so far; each sample reports all
+        # of them, 0 for the ones that did not run that frame
+        self.names = set()
+        self.timers = {}
+        self.lastTimers = {}
+        self.started = {}
+        self.collectors = {}
+        self.frame = 0
+        self.lastFrameTime = None
+        self.overlay = None
+        self.overlayEvery = 10
+        self.log = None
+        self.logColumns = None
+
+    def declare(self, *names):
+        """
+            Report these timers from the first sample on, e.g. sections that
+            only run on some frames, so a CSV log has a column for them.
+        """
+        self.names.update(names)
+
+    def collector(self, name):
+        if name not in self.collectors:
+            self.collectors[name] = PStatCollector("App:Game:%s" % name)
+        return self.collectors[name]
+
+    def start(self, name):
+        self.names.add(name)
+        self.collector(name).start()
+        self.started[name] = clock()
+
+    def stop(self, name):
+        elapsed = clock() - self.started.pop(name)
+        self.timers[name] = self.timers.get(name, 0.0) + elapsed
+        self.collector(name).stop()
+
+    def wrap(self, name, func):
+        """
+            A task function that runs func under the timer `name`.
+        """
+        self.declare(name)
+        def timed(task):
+            self.start(name)
+            try:
+                return func(task)
+            finally:
+                self.stop(name)
+        return timed
+
+    def connectPStats(self):
+        if not PStatClient.isConnected():
+            PStatClient.connect()
+        return PStatClient.isConnected()
+
+    def showOverlay(self):
+        if self.overlay is None:
+            self.overlay = OnscreenText(text = "", pos = (-1.3, 0.8), scale = 0.04, fg=(0.6,1,0.6,1),
+                                        align=TextNode.ALeft, mayChange=1)
+        else:
+            self.overlay.show()
+
+    def hideOverlay(self):
+        if self.overlay is not None:
+            self.overlay.hide()
+
+    def toggleOverlay(self):
+        if self.overlay is None or self.overlay.isHidden():
+            self.showOverlay()
+        else:
+            self.hideOverlay()
+
+    def openLog(self, path):
+        """
+            Stream one sample per frame to path: CSV for a .csv file,
+            otherwise one JSON object per line.
+        """
+        self.closeLog()
+        self.log = open(path, "w")
+        self.logCsv = path.endswith(".csv")
+        self.logColumns = None
+
+    def closeLog(self):
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+    def sample(self, dt):
+        sample = {"frame": self.frame, "dt_ms": dt * 1000}
+        for name in self.names:
+            sample[name + "_ms"] = self.timers.get(name, 0.0) * 1000
+        if self.counters is not None:
+            sample.update(self.counters())
+        return sample
+
+    def writeSample(self, sample):
+        if not self.logCsv:
+            self.log.write(json.dumps(sample, sort_keys=True) + "\n")
+            return
+        if self.logColumns is None:
+            self.logColumns = sorted(sample)
+            self.log.write(",".join(self.logColumns) + "\n")
+        self.log.write(",".join(["%g" % sample.get(column, 0) for column in self.logColumns]) + "\n")
+
+    def endFrame(self, task):
+        now = globalClock.getRealTime()
+        dt = 0.0 if self.lastFrameTime is None else now - self.lastFrameTime
+        self.lastFrameTime = now
+
+        showing = self.overlay is not None and not self.overlay.isHidden() and \
+            self.frame % self.overlayEvery == 0
+        if showing or self.log is not None:
+            sample = self.sample(dt)
+            if showing:
+                lines = ["%-18s %8.2f" % (key, sample[key]) for key in sorted(sample)]
+                self.overlay.setText("\n".join(lines))
+            if self.log is not None:
+                self.writeSample(sample)
+
+        self.lastTimers = self.timers
+        self.timers = {}
+        self.frame += 1
+        return task.cont
@@ -0,0 +1,150 @@
+"""
+    Proximity queries around the player.
+
+    Obstacles, pickups and the goal are kept in a uniform-grid spatial hash
+    on the XY plane. Each frame a single query around the subject finds what
+    is in range, and enter/exit handlers fire when that changes.
+"""
+import math
+
+
+class SpatialHash(object):
+    """
+        Buckets are lists so queries yield items in a fixed order from run
+        to run; sets of id-hashed objects would not.
+    """
+
+    def __init__(self, cellSize):
+        self.cellSize = float(cellSize)
+        self.cells = {}
+        self.cellOfItem = {}
+
+    def cellOf(self, x, y):
+        return (int(math.floor(x / self.cellSize)), int(math.floor(y / self.cellSize)))
+
+    def insert(self, item, x, y):
+        cell = self.cellOf(x, y)
+        self.cells.setdefault(cell, []).append(item)
+        self.cellOfItem[item] = cell
+
+    def remove(self, item):
+        cell = self.cellOfItem.pop(item)
+        bucket = self.cells[cell]
+        bucket.remove(item)
+        if not bucket:
+            del self.cells[cell]
+
+    def move(self, item, x, y):
+        cell = self.cellOf(x, y)
+        if self.cellOfItem.get(item) != cell:
+            self.remove(item)
+            self.cells.setdefault(cell, []).append(item)
+            self.cellOfItem[item] = cell
+
+    def query(self, x, y, radius):
+        """
+            Items in every cell overlapped by the square around (x, y).
+            Callers do the exact distance test.
+        """
+        x0, y0 = self.cellOf(x - radius, y - radius)
+        x1, y1 = self.cellOf(x + radius, y + radius)
+        cells = self.cells
+        for cx in range(x0, x1 + 1):
+            for cy in range(y0, y1 + 1):
+                bucket = cells.get((cx, cy))
+                if bucket:
+                    for item in bucket:
+                        yield item
+
+
+class Proximate(object):
+
+    def __init__(self, nodePath, radius, kind, onEnter, onExit, moving):
+        self.nodePath = nodePath
+        self.radius = radius
+        self.kind = kind
+        self.onEnter = onEnter
+        self.onExit = onExit
+        self.moving = moving
+
+
+class Proximity(object):
+    """
+        Tracks which registered nodes are within their radius of `subject`.
+        Radii are in world units.
+    """
+
+    def __init__(self, subject, cellSize=8.0):
+        self.subject = subject
+        self.grid = SpatialHash(cellSize)
+        self.entries = {}
+        self.moving = []
+        self.inside = set()
+        self.insideOrder = []
+        self.maxRadius = 0.0
+
+    def add(self, nodePath, radius, kind, onEnter=None, onExit=None, moving=False):
+        entry = Proximate(nodePath, radius, kind, onEnter, onExit, moving)
+        self.entries[nodePath] = entry
+        self.grid.insert(entry, nodePath.getX(render), nodePath.getY(render))
+        if moving:
+            self.moving.append(entry)
+        self.maxRadius = max(self.maxRadius, radius)
+        return entry
+
+    def remove(self, nodePath):
+        entry = self.entries.pop(nodePath, None)
+        if entry is None:
+            return
+        self.grid.remove(entry)
+        self.inside.discard(entry)
+        if entry in self.insideOrder:
+            self.insideOrder.remove(entry)
+        if entry.moving:
+            self.moving.remove(entry)
+
+    def near(self, x, y, radius, kind=None):
+        """
+            Entries, of `kind` if given, that may reach within radius of
+            (x, y). Callers do the exact test against each entry's radius.
+        """
+        for entry in self.grid.query(x, y, radius + self.maxRadius):
+            if kind is None or entry.kind == kind:
+                yield entry
+
+    def count(self, kind):
+        n = 0
+        for entry in self.inside:
+            if entry.kind == kind:
+                n += 1
+        return n
+
+    def update(self):
+        """
+            Re-bucket the moving entries, query around the subject once and
+            fire enter/exit handlers for whatever changed.
+        """
+        for entry in self.moving:
+            pos = entry.nodePath.getPos(render)
+            self.grid.move(entry, pos[0], pos[1])
+
+        center = self.subject.getPos(render)
+        inside = []
+        for entry in self.grid.query(center[0], center[1], self.maxRadius):
+            offset = entry.nodePath.getPos(render) - center
+            if offset.lengthSquared() < entry.radius * entry.radius:
+                inside.append(entry)
+
+        # Keep handler order the same as the query order
+        entered = [entry for entry in inside if entry not in self.inside]
+        exited = [entry for entry in self.insideOrder if entry not in inside]
+        self.insideOrder = inside
+        self.inside = set(inside)
+
+        # Handlers may remove entries, so dispatch only after the sweep
+        for entry in exited:
+            if entry.onExit is not None:
+                entry.onExit(entry.nodePath)
+        for entry in entered:
+            if entry.onEnter is not None:
+                entry.onEnter(entry.nodePath)
@@ -0,0 +1,175 @@
+"""
+    Recording and replaying game sessions.
+
+    A recording holds everything a session's outcome depends on: the RNG
+    seed, the level and every setting a session runs with (speed, time
+    limit, flock, steering and LOD) as JSON in a header, so sessions run
+    with batch.py or bench.py overrides replay as played. Then comes one
+    small record per frame with the frame's dt, the movement keys held and
+    the mouse offset that updateGame used. Replaying sets the clock to each
+    recorded dt and feeds the same input back through World, so the session
+    plays out the same way, headless at full speed or in a window.
+
+    python replay.py session.rec [--windowed] [--profile-log frames.csv]
+"""
+from panda3d.core import ClockObject
+from level import flockParams
+import argparse, json, struct
+
+MAGIC = b"REC2"
+# Length of the JSON session settings that follow
+HEADER = struct.Struct("<4sI")
+# dt, key bitmask, mouse offset in pixels
+FRAME = struct.Struct("<dBf")
+# Bit order of World.keyMap entries in the key bitmask
+KEYS = ("left", "right", "forward", "backward", "cam-left", "cam-right")
+
+
+def sessionSettings(world):
+    """
+        The settings of the session World has just reset for.
+    """
+    level = world.level
+    return {"level": world.levelPath,
+            "seed": world.sessionSeed,
+            "obstacle_count": world.obstacle_count,
+            "steering": world.steeringBackend,
+            "crowd_mode": world.crowdMode,
+            "speed": world.startSpeed,
+            "time_limit": level.timeLimit,
+            "health": level.health,
+            "damage_per_second": level.damagePerSecond,
+            "flock": list(world.flockParams),
+            "ai": list(world.flockerAIParams),
+            "pursue": world.pursueWeight,
+            "lod_bands": world.lodBands,
+            "use_height_field": world.useHeightField,
+            "sim_step": world.simStep,
+            "max_frame_time": world.maxFrameTime}
+
+
+class Recorder(object):
+
+    def __init__(self, world, path):
+        self.file = open(path, "wb")
+        settings = json.dumps(sessionSettings(world), sort_keys=True).encode("utf-8")
+        self.file.write(HEADER.pack(MAGIC, len(settings)) + settings)
+        self.frames = 0
+
+    def write(self, dt, keyMap, mouseDx):
+        keys = 0
+        for bit, key in enumerate(KEYS):
+            if keyMap[key]:
+                keys |= 1 << bit
+        self.file.write(FRAME.pack(dt, keys, mouseDx))
+        self.frames += 1
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class Recording(object):
+
+    def __init__(self, settings, frames):
+        # As written by sessionSettings()
+        self.settings = settings
+        # Raw FRAME records, unpacked one at a time during playback
+        self.frames = frames
+
+    def __len__(self):
+        return len(self.frames) // FRAME.size
+
+    def configure(self, world):
+        """
+            Give a World built for replay the recorded settings.
+        """
+        settings = self.settings
+        if world.levelPath != settings["level"]:
+            world.setLevel(settings["level"])
+        world.seed = settings["seed"]
+        world.obstacle_count = settings["obstacle_count"]
+        world.steeringBackend = settings["steering"]
+        world.crowdMode = settings["crowd_mode"]
+        world.speed = settings["speed"]
+        world.level.timeLimit = settings["time_limit"]
+        world.level.health = settings["health"]
+        world.level.damagePerSecond = settings["damage_per_second"]
+        world.flockParams = flockParams(settings["flock"])
+        world.flockerAIParams = tuple(settings["ai"])
+        world.pursueWeight = settings["pursue"]
+        world.lodBands = None
+        if settings["lod_bands"] is not None:
+            world.lodBands = tuple(tuple(band) for band in settings["lod_bands"])
+        world.useHeightField = settings["use_height_field"]
+        world.simStep = settings["sim_step"]
+        world.maxFrameTime = settings["max_frame_time"]
+
+    @classmethod
+    def load(cls, path):
+        f = open(path, "rb")
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        magic, length = HEADER.unpack_from(data, 0)
+        if magic != MAGIC:
+            raise IOError("%s is not a session recording" % path)
+        start = HEADER.size + length
+        settings = json.loads(data[HEADER.size:start].decode("utf-8"))
+        return cls(settings, data[start:])
+
+
+class Player(object):
+    """
+        Feeds a Recording to a World one frame at a time. update() must run
+        before each taskMgr.step(), e.g. as a headless Simulation driver.
+    """
+
+    def __init__(self, world, recording):
+        self.world = world
+        self.recording = recording
+        self.next = 0
+        self.mouseDx = 0.0
+        self.done = len(recording) == 0
+        # Frame times come from the recording, not the wall clock
+        globalClock.setMode(ClockObject.MNonRealTime)
+        world.replayer = self
+
+    def update(self):
+        if self.done:
+            return
+        dt, keys, self.mouseDx = FRAME.unpack_from(self.recording.frames, self.next * FRAME.size)
+        self.next += 1
+        self.done = self.next >= len(self.recording)
+        globalClock.setDt(dt)
+        for bit, key in enumerate(KEYS):
+            self.world.setKey(key, (keys >> bit) & 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Play back a recorded session")
+    parser.add_argument("recording")
+    parser.add_argument("--windowed", action="store_true", help="render the replay")
+    parser.add_argument("--profile-log", help="per-frame timers as .csv or JSON lines")
+    args = parser.parse_args()
+
+    from headless import Simulation
+    recording = Recording.load(args.recording)
+
+    def configure(world):
+        recording.configure(world)
+        world.profileLog = args.profile_log
+
+    sim = Simulation(configure=configure, windowed=args.windowed)
+    player = Player(sim.world, recording)
+    sim.driver = player
+    report = sim.run(float("inf"), lambda: player.done)
+    sim.world.profiler.closeLog()
+    report["recorded_frames"] = len(recording)
+    print(json.dumps(report, indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
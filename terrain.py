@@ -0,0 +1,188 @@
+"""
+    Precomputed terrain heights for the world model.
+
+    The height field is baked once by casting a grid of downward rays at the
+    world's collision geometry, the same way the game's ground rays do, and
+    is stored next to the model. Looking up a ground height is then a
+    bilinear blend of four grid samples instead of a collision traversal.
+"""
+from panda3d.core import CollisionTraverser, CollisionNode
+from panda3d.core import CollisionHandlerQueue, CollisionRay, BitMask32
+from array import array
+import math, os, struct, sys, zlib
+
+MAGIC = b"HGT2"
+# nx, ny, minX, minY, step, then the source model's CRC, the rays' from
+# mask and the CRC of the terrain's node name
+HEADER = struct.Struct("<4sIIfffIII")
+
+
+def fileCrc(path):
+    f = open(path, "rb")
+    try:
+        return zlib.crc32(f.read()) & 0xffffffff
+    finally:
+        f.close()
+
+
+def nameCrc(name):
+    return zlib.crc32(name.encode("utf-8")) & 0xffffffff
+
+
+class HeightField(object):
+
+    def __init__(self, nx, ny, minX, minY, step, heights, sourceCrc=0, fromMask=0, terrainCrc=0):
+        self.nx = nx
+        self.ny = ny
+        self.minX = minX
+        self.minY = minY
+        self.step = step
+        # Row-major samples; NaN where the highest surface is not terrain
+        self.heights = heights
+        # Checksum of the model file the samples were baked from, and what
+        # the bake's rays collided with and counted as terrain
+        self.sourceCrc = sourceCrc
+        self.fromMask = fromMask
+        self.terrainCrc = terrainCrc
+
+    def bakedWith(self, sourceCrc, step, fromMask, terrainName):
+        """
+            Whether these samples came from the same model and bake settings.
+        """
+        return (self.sourceCrc == sourceCrc and abs(self.step - step) < 1e-6 and
+                self.fromMask == fromMask.getWord() and self.terrainCrc == nameCrc(terrainName))
+
+    def getHeight(self, x, y):
+        """
+            Terrain Z at (x, y). Returns None off the grid, and NaN where the
+            ground rays would not have landed on terrain.
+        """
+        fx = (x - self.minX) / self.step
+        fy = (y - self.minY) / self.step
+        i = int(math.floor(fx))
+        j = int(math.floor(fy))
+        if i < 0 or j < 0 or i >= self.nx - 1 or j >= self.ny - 1:
+            return None
+
+        index = j * self.nx + i
+        h = self.heights
+        h00 = h[index]
+        h10 = h[index + 1]
+        h01 = h[index + self.nx]
+        h11 = h[index + self.nx + 1]
+        tx = fx - i
+        ty = fy - j
+        # NaN in any corner propagates, so holes stay holes
+        return ((h00 * (1 - tx) + h10 * tx) * (1 - ty) +
+                (h01 * (1 - tx) + h11 * tx) * ty)
+
+    def save(self, path):
+        heights = array('f', self.heights)
+        if sys.byteorder == "big":
+            heights.byteswap()
+        f = open(path, "wb")
+        try:
+            f.write(HEADER.pack(MAGIC, self.nx, self.ny, self.minX, self.minY, self.step,
+                                self.sourceCrc, self.fromMask, self.terrainCrc))
+            heights.tofile(f)
+        finally:
+            f.close()
+
+    @classmethod
+    def load(cls, path):
+        f = open(path, "rb")
+        try:
+            data = f.read(HEADER.size)
+            if len(data) < HEADER.size or data[:4] != MAGIC:
+                raise IOError("%s is not a height field" % path)
+            magic, nx, ny, minX, minY, step, sourceCrc, fromMask, terrainCrc = HEADER.unpack(data)
+            heights = array('f')
+            heights.fromfile(f, nx * ny)
+        finally:
+            f.close()
+        if sys.byteorder == "big":
+            heights.byteswap()
+        return cls(nx, ny, minX, minY, step, heights, sourceCrc, fromMask, terrainCrc)
+
+    @classmethod
+    def bake(cls, environment, step=0.5, terrainName="terrain", fromMask=BitMask32.bit(0)):
+        """
+            Sample the environment's collision geometry on a regular grid.
+            A sample keeps its height only if the highest surface under it is
+            the terrain, matching how the game treats its ground rays.
+            fromMask must reach the terrain and everything that stands on it.
+        """
+        bounds = environment.getTightBounds()
+        minX, minY = bounds[0][0], bounds[0][1]
+        nx = int(math.ceil((bounds[1][0] - minX) / step)) + 1
+        ny = int(math.ceil((bounds[1][1] - minY) / step)) + 1
+        heights = array('f', [float("nan")] * (nx * ny))
+
+        # One collision node holds a whole row of rays, so each traversal
+        # samples nx points at once
+        trav = CollisionTraverser()
+        rowNode = CollisionNode("heightFieldRow")
+        rowNode.setFromCollideMask(fromMask)
+        rowNode.setIntoCollideMask(BitMask32.allOff())
+        for i in range(nx):
+            rowNode.addSolid(CollisionRay(minX + i * step, 0, 1000, 0, 0, -1))
+        rowNp = environment.attachNewNode(rowNode)
+        handler = CollisionHandlerQueue()
+        trav.addCollider(rowNp, handler)
+
+        for j in range(ny):
+            rowNp.setY(minY + j * step)
+            trav.traverse(environment)
+            best = {}
+            for k in range(handler.getNumEntries()):
+                entry = handler.getEntry(k)
+                i = int(round((entry.getFrom().getOrigin().getX() - minX) / step))
+                z = entry.getSurfacePoint(environment).getZ()
+                if i not in best or z > best[i][0]:
+                    best[i] = (z, entry.getIntoNode().getName())
+            for i, (z, name) in best.items():
+                if name == terrainName:
+                    heights[j * nx + i] = z
+
+        rowNp.removeNode()
+        return cls(nx, ny, minX, minY, step, heights, 0, fromMask.getWord(), nameCrc(terrainName))
+
+    @classmethod
+    def loadOrBake(cls, environment, sourcePath, cachePath, step=0.5, terrainName="terrain",
+                   fromMask=BitMask32.bit(0)):
+        """
+            Load the cached height field, baking it first if it is missing,
+            from an older format, or was baked from a different version of
+            the model or with different settings.
+        """
+        sourceCrc = fileCrc(sourcePath)
+        if os.path.exists(cachePath):
+            try:
+                field = cls.load(cachePath)
+            except IOError:
+                field = None
+            if field is not None and field.bakedWith(sourceCrc, step, fromMask, terrainName):
+                return field
+        field = cls.bake(environment, step, terrainName, fromMask)
+        field.sourceCrc = sourceCrc
+        try:
+            field.save(cachePath)
+        except (IOError, OSError):
+            # A read-only install can still use the freshly baked field
+            pass
+        return field
+
+
+if __name__ == "__main__":
+    # python terrain.py : bake models/world.hgt ahead of time
+    from panda3d.core import loadPrcFileData
+    loadPrcFileData("terrain", "window-type none\naudio-library-name null")
+    from direct.showbase.ShowBase import ShowBase
+    from level import TERRAIN_MASK, BLOCKER_MASK
+    base = ShowBase()
+    world = base.loader.loadModel("models/world")
+    # The same rays the game bakes with, so it accepts the file
+    field = HeightField.bake(world, fromMask=TERRAIN_MASK | BLOCKER_MASK)
+    field.sourceCrc = fileCrc("models/world.egg.pz")
+    field.save("models/world.hgt")
+    print("baked %dx%d samples to models/world.hgt" % (field.nx, field.ny))